@@ -0,0 +1,125 @@
+'''
+Time of merging documents with _add (Dict + Dict), compared to the former
+implementation (remap over b, looking a up with getx and writing it back
+with setx, from the root, for every node), on the same documents.
+
+    python benchmarks/add.py --documents 200 --depth 3,6,10 --width 6
+
+Prints the time of both, per depth, and exits with 1, if _add is not at
+least --min-speedup times faster than the former one (so that the check
+does not depend on the machine it runs on).
+'''
+import argparse
+import os
+import random
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metaform.utils import _add, getx, setx  # noqa: E402
+
+
+def previous_add(a, b):
+    from boltons.iterutils import remap
+    a = deepcopy(a)
+
+    def visit(path, key, value):
+        fpath = path + (key,)
+        val = getx(a, fpath)
+
+        if val is not None:
+            if not isinstance(val, type(value)):
+                new_val = [val, value]
+            else:
+                if type(getx(a, fpath[:-1])) in [list, tuple]:
+                    if type(getx(b, fpath[:-1])) in [list, tuple]:
+                        return key, value
+
+                if hasattr(val, '__add__'):
+                    new_val = val + value
+                else:
+                    if val == value:
+                        new_val = val
+                    else:
+                        new_val = [val, value]
+
+            setx(a, fpath, new_val, b)
+        else:
+            setx(a, fpath, value, b)
+
+        return key, value
+
+    remap(b, visit=visit)
+    return a
+
+
+def make_document(width, depth, rng, level=0):
+    '''
+    Returns a document of width fields per level, where the last field of
+    the levels above depth is a nested document, and the one before it a
+    list of numbers.
+    '''
+    document = {}
+    for i in range(width):
+        key = 'f{}'.format(i)
+        if level < depth - 1 and i == width - 1:
+            document[key] = make_document(width, depth, rng, level + 1)
+        elif i == width - 2:
+            document[key] = [rng.randint(0, 9) for _ in range(3)]
+        else:
+            document[key] = rng.choice([rng.randint(0, 100), 'value-{}'.format(rng.randint(0, 9))])
+    return document
+
+
+def measure(function, pairs, repeat=3):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for a, b in pairs:
+            function(a, b)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--depth', default='3,6,10', help='comma separated levels of nesting')
+    parser.add_argument('--width', type=int, default=6, help='fields per level')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-speedup', type=float, default=None, help='minimum speedup over the former _add')
+    args = parser.parse_args()
+
+    if args.width < 2:
+        parser.error('--width must be at least 2')
+
+    rng = random.Random(0)
+    slower = []
+
+    for depth in [int(depth) for depth in args.depth.split(',')]:
+        pairs = [(make_document(args.width, depth, rng), make_document(args.width, depth, rng))
+                 for _ in range(args.documents)]
+
+        for a, b in pairs[:10]:
+            assert _add(a, b) == previous_add(a, b), 'Results differ from the former _add'
+
+        current = measure(_add, pairs, args.repeat)
+        previous = measure(previous_add, pairs, args.repeat)
+        speedup = previous / current
+
+        print('depth {:<3} _add {:>8.1f} ms, former {:>8.1f} ms, {:.1f}x'.format(
+            depth, current * 1000, previous * 1000, speedup))
+
+        if args.min_speedup is not None and speedup < args.min_speedup:
+            slower.append(depth)
+
+    if slower:
+        print('Regression: _add is less than {}x faster at depth {}'.format(
+            args.min_speedup, ', '.join(map(str, slower))))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+'''
+Throughput and peak memory of the normalization hot paths, on synthetic
+nested records, offline (the schema and concept caches are stubbed, so no
+schema or concept is fetched).
+
+    python benchmarks/hot_paths.py --records 2000 --width 8 --depth 3
+    python benchmarks/hot_paths.py --only normalize,format --repeat 5
+
+Prints records per second and peak memory per benchmark, next to the ones
+of the baseline (benchmarks/baseline.json). The baseline is measured on one
+machine, so the results are checked against it only with --compare (or,
+BENCH_COMPARE=1), e.g., on that machine, or in CI, with a baseline saved on
+the same runner. Then it exits with 1, if any is slower or takes more
+memory than the baseline by more than --tolerance:
+
+    BENCH_COMPARE=1 make benchmark
+
+The baseline is only compared to runs of the same dataset size, and is
+rewritten with:
+
+    python benchmarks/hot_paths.py --save
+'''
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metaform  # noqa: E402
+from metaform import utils  # noqa: E402
+from metaform.cache import MemoryStore  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Formats of the leaves, cycled through by field.
+FORMATS = ['integer', 'string', 'float', 'isodate']
+
+
+def term(level, i):
+    return '_:l{}-f{}'.format(level, i)
+
+
+def leaf(fmt, rng):
+    if fmt == 'integer':
+        return str(rng.randint(0, 10 ** 6))
+    if fmt == 'float':
+        return str(rng.random() * 1000)
+    if fmt == 'isodate':
+        return '20{:02d}-0{}-1{}T10:00:00'.format(rng.randint(0, 20), rng.randint(1, 9), rng.randint(0, 9))
+    return 'value-{}'.format(rng.randint(0, 1000))
+
+
+def make_record(width, depth, rng, level=0):
+    '''
+    Returns a record of width fields per level, where the last field of the
+    levels above depth is a nested record, and the one before it a list of
+    two of them.
+    '''
+    record = {}
+    for i in range(width):
+        key = 'f{}'.format(i)
+        if level < depth - 1 and i == width - 1:
+            record[key] = make_record(width, depth, rng, level + 1)
+        elif level < depth - 1 and i == width - 2:
+            record[key] = [make_record(width, depth, rng, level + 1) for _ in range(2)]
+        else:
+            record[key] = leaf(FORMATS[i % len(FORMATS)], rng)
+    return record
+
+
+def make_schema(width, depth, level=0):
+    '''
+    Returns the schema of make_record(width, depth) records, renaming every
+    field to a term with a format, and converting some by rules.
+    '''
+    schema = {}
+    for i in range(width):
+        key = 'f{}'.format(i)
+        name = '{}#{}'.format(term(level, i), FORMATS[i % len(FORMATS)])
+        if level < depth - 1 and i == width - 1:
+            schema[key] = dict(make_schema(width, depth, level + 1), **{'*': term(level, i)})
+        elif level < depth - 1 and i == width - 2:
+            schema[key] = [dict(make_schema(width, depth, level + 1), **{'*': term(level, i)})]
+        elif i % 3 == 1:
+            schema[key] = {'*': name + '|lambda x: str(x).strip()'}
+        else:
+            schema[key] = {'*': name}
+    return schema
+
+
+def make_dataset(records=1000, width=8, depth=3, seed=0):
+    rng = random.Random(seed)
+    return [make_record(width, depth, rng) for _ in range(records)], make_schema(width, depth)
+
+
+def offline(width, depth):
+    '''
+    Stubs the caches: the concepts of the terms (with English aliases) are
+    in the concept memo, the stores are in memory, and fetching raises.
+    '''
+    def unavailable(url):
+        raise RuntimeError('Benchmarks run offline: {}'.format(url))
+
+    utils.concepts = MemoryStore()
+    utils.schemas = MemoryStore()
+    utils.Concept = unavailable
+    utils.t_get_schema = unavailable
+    utils.concept_memo.clear()
+
+    for level in range(depth):
+        for i in range(width):
+            utils.concept_memo.set(term(level, i), {'aliases': {'en': ['level-{}-field-{}'.format(level, i)]}})
+
+
+def leaves(record, schema):
+    '''
+    Returns the (key, value, schema) of the leaves of record, as convert()
+    gets them.
+    '''
+    items = []
+    for key, value in record.items():
+        sub = schema[key]
+        if isinstance(value, dict):
+            items.extend(leaves(value, sub))
+        elif isinstance(value, list):
+            for item in value:
+                items.extend(leaves(item, sub[0]))
+        else:
+            items.append((key, value, sub))
+    return items
+
+
+def write_csv(records, path):
+    flat = [{key: value for key, value in record.items() if isinstance(value, str)} for record in records]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(flat[0]))
+        writer.writeheader()
+        writer.writerows(flat)
+
+
+def read_csv(path, schema):
+    with redirect_stdout(io.StringIO()):
+        return metaform.read_csv(path, schema=schema)
+
+
+def benchmarks(records, schema, directory):
+    '''
+    Returns {name: (setup, function)}, where function(data) is timed, and
+    data = setup() is not. Setups are done before timing, once per run.
+    '''
+    ndata = metaform.normalize(records, [schema])
+    fdata = metaform.formatize(ndata)
+    others = [dict(record, extra='x') for record in records]
+    items = [item for record in records for item in leaves(record, schema)]
+
+    path = os.path.join(directory, 'records.csv')
+    write_csv(records, path)
+    columns = {key: value for key, value in schema.items() if not isinstance(value, list) and '*' in value}
+
+    return {
+        'normalize': (lambda: records, lambda data: metaform.normalize(data, [schema])),
+        'formatize': (lambda: ndata, metaform.formatize),
+        'translate': (lambda: fdata, lambda data: metaform.translate(data, lang='en')),
+        'format': (lambda: metaform.List(records), lambda data: data.format(schema, anchors=False, lang='en')),
+        'convert': (lambda: items, lambda data: [metaform.convert(*item) for item in data]),
+        '_add': (lambda: (deepcopy(records), others), lambda data: [
+            utils._add(a, b, inplace=True) for a, b in zip(*data)]),
+        '_sub': (lambda: (records, others), lambda data: [utils._sub(b, a) for a, b in zip(*data)]),
+        'align': (lambda: [records, others], lambda data: list(metaform.align(data, sample=10))),
+        'metaplate': (lambda: records, lambda data: [utils.metaplate(record) for record in data]),
+        'read_csv': (lambda: path, lambda data: read_csv(data, columns)),
+    }
+
+
+def measure(setup, function, repeat=3):
+    '''
+    Returns the best time of repeat runs (seconds), and the peak memory of
+    a separate traced run (bytes).
+    '''
+    times = []
+    for _ in range(repeat):
+        data = setup()
+        started = time.perf_counter()
+        function(data)
+        times.append(time.perf_counter() - started)
+
+    data = setup()
+    tracemalloc.start()
+    try:
+        function(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns {name: [regressions]} of results, compared to baseline.
+    '''
+    regressions = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        found = []
+        if result['records_per_s'] < base['records_per_s'] * (1 - tolerance):
+            found.append('throughput {:.0%} of baseline'.format(result['records_per_s'] / base['records_per_s']))
+        if result['peak_kb'] > base['peak_kb'] * (1 + tolerance):
+            found.append('peak memory {:.0%} of baseline'.format(result['peak_kb'] / base['peak_kb']))
+        if found:
+            regressions[name] = found
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=8, help='fields per level')
+    parser.add_argument('--depth', type=int, default=3, help='levels of nesting')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default=None, help='comma separated benchmarks to run')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed slowdown, or memory increase')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--compare', action='store_true', default=os.environ.get('BENCH_COMPARE', '0') != '0',
+                        help='exit with 1 on regressions against the baseline (default: $BENCH_COMPARE)')
+    args = parser.parse_args()
+
+    if args.width < 2:
+        parser.error('--width must be at least 2')
+
+    params = {'records': args.records, 'width': args.width, 'depth': args.depth}
+    records, schema = make_dataset(**params)
+    offline(args.width, args.depth)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored.get('params') == params:
+            baseline = stored['results']
+        else:
+            print('Baseline is of another dataset ({}), not comparing.'.format(stored.get('params')))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        suite = benchmarks(records, schema, directory)
+        names = args.only.split(',') if args.only else list(suite)
+
+        for name in names:
+            if name not in suite:
+                parser.error('Unknown benchmark: {} (expected one of {})'.format(name, ', '.join(suite)))
+
+            if name == 'read_csv':
+                try:
+                    import pandas  # noqa
+                except ImportError:
+                    print('{:<10} skipped, pip install pandas to run it.'.format(name))
+                    continue
+
+            seconds, peak = measure(*suite[name], repeat=args.repeat)
+            results[name] = {'records_per_s': round(args.records / seconds, 1), 'peak_kb': round(peak / 1024, 1)}
+
+            base = baseline.get(name)
+            print('{:<10} {:>12,.0f} records/s {:>10,.0f} KB peak{}'.format(
+                name, results[name]['records_per_s'], results[name]['peak_kb'],
+                '  (baseline {:,.0f} records/s, {:,.0f} KB)'.format(
+                    base['records_per_s'], base['peak_kb']) if base else ''))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved the baseline to {}'.format(args.baseline))
+        return
+
+    if not args.compare:
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, found in regressions.items():
+        print('Regression in {}: {}'.format(name, ', '.join(found)))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''
+Time of `import metaform` in a fresh interpreter (what a short-lived CLI, or
+a serverless worker pays on every invocation).
+
+    python benchmarks/import_time.py --runs 20 --max 150
+
+Prints the best and median time in milliseconds, and exits with 1, if the
+median is above --max (so that it can guard against import time regressions).
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+
+CODE = 'import time; t = time.perf_counter(); import metaform; print(time.perf_counter() - t)'
+
+
+def measure(runs=10):
+    return [
+        float(subprocess.check_output([sys.executable, '-c', CODE], universal_newlines=True)) * 1000
+        for _ in range(runs)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max', type=float, default=None, help='maximum median import time, ms')
+    args = parser.parse_args()
+
+    times = measure(args.runs)
+    median = statistics.median(times)
+    print('import metaform: best {:.1f} ms, median {:.1f} ms ({} runs)'.format(min(times), median, args.runs))
+
+    if args.max is not None and median > args.max:
+        print('Import time regression: median {:.1f} ms > {:.1f} ms'.format(median, args.max))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
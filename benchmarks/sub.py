@@ -0,0 +1,187 @@
+'''
+Time of subtracting documents with _sub (Dict - Dict), compared to the
+former implementation (remap over b, looking a up with getx, and for list
+items, in every item of the list, from the root, for every node), and a
+randomized check, that both give the same, where the former one is
+defined: dicts walked key by key, and no lists (or, sets) of b subtracted
+from lists of a, as it subtracted those by position.
+
+    python benchmarks/sub.py --items 500,1000,2000 --documents 20000
+
+Prints the time of both, per number of list items, and exits with 1, if
+any of the random documents gives another result, or _sub is not at least
+--min-speedup times faster than the former one.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metaform.utils import _sub, delx, getx, setx  # noqa: E402
+
+KEYS = 'abcde'
+
+
+def previous_sub(a, b):
+    from boltons.iterutils import remap
+    a = deepcopy(a)
+    a['___previous_was_list___'] = False
+
+    def visit(path, key, value):
+        fpath = path + (key,)
+        vala = getx(a, fpath)
+        valb = value
+
+        if isinstance(getx(a, fpath[:-1]), list):
+            valA = getx(a, fpath, inany=True)
+        else:
+            valA = None
+
+        if vala is not None:
+            if not isinstance(vala, type(valb)):
+                if not isinstance(vala, list):
+                    vala = [vala]
+                if not isinstance(valb, list):
+                    valb = [valb]
+                new_val = [v for v in vala if v in valb]
+                if len(new_val) == 1:
+                    new_val = new_val[0]
+                if not a['___previous_was_list___']:
+                    setx(a, fpath, new_val, b)
+                a['___previous_was_list___'] = False
+            elif hasattr(vala, '__sub__'):
+                new_val = vala - valb
+                if not a['___previous_was_list___']:
+                    if new_val:
+                        setx(a, fpath, new_val, b)
+                    else:
+                        delx(a, fpath)
+
+        else:
+            if valA is not None:
+                npath, _ = valA
+                delx(a, npath[:-1])
+                a['___previous_was_list___'] = True
+        return key, value
+
+    remap(b, visit=visit)
+    del a['___previous_was_list___']
+    return a
+
+
+def scalar(rng):
+    return rng.choice([0, 1, 2, 3, -1, 1.5, 2.5, True, False, 'x', 'y', '', None, {1, 2}, frozenset({2})])
+
+
+def make_value(rng, depth):
+    r = rng.random()
+    if depth < 3 and r < .3:
+        return make_document(rng, depth + 1)
+    if r < .45:
+        return [rng.choice([make_value(rng, 3), scalar(rng)]) for _ in range(rng.randint(0, 3))]
+    return scalar(rng)
+
+
+def make_document(rng, depth=0):
+    return {key: make_value(rng, depth) for key in rng.sample(KEYS, rng.randint(0, 4))}
+
+
+def make_other(a, rng, depth=0):
+    '''
+    Returns a document to subtract from a, with dicts (or, anything) at the
+    paths of the dicts of a, and scalars (but sets) at the ones of lists.
+    '''
+    b = {}
+    for key in rng.sample(KEYS, rng.randint(0, 5)):
+        value = a.get(key)
+        r = rng.random()
+        if isinstance(value, dict):
+            if r < .6:
+                b[key] = make_other(value, rng, depth + 1)
+            else:
+                b[key] = scalar(rng) if r < .8 else [scalar(rng) for _ in range(2)]
+        elif isinstance(value, list):
+            b[key] = rng.choice(value) if value and r < .3 else scalar(rng)
+            while isinstance(b[key], (list, dict, set, frozenset)):
+                b[key] = scalar(rng)
+        elif key in a and r < .5:
+            b[key] = deepcopy(value) if r < .25 else type(value)(1) if isinstance(value, (int, float)) else scalar(rng)
+        else:
+            b[key] = make_value(rng, depth) if depth < 3 else scalar(rng)
+    return b
+
+
+def check(documents, seed=0):
+    '''
+    Returns the (a, b) of the random documents, that _sub and the former
+    implementation give different results for.
+    '''
+    rng = random.Random(seed)
+    different = []
+
+    for _ in range(documents):
+        a = make_document(rng)
+        b = make_other(a, rng)
+        results = []
+        for function in (_sub, previous_sub):
+            try:
+                results.append(repr(function(deepcopy(a), deepcopy(b))))
+            except Exception as e:
+                results.append('raised {!r}'.format(e))
+        if results[0] != results[1]:
+            different.append((a, b))
+
+    return different
+
+
+def measure(function, a, b, repeat=3):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(a, b)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', default='500,1000,2000', help='comma separated numbers of list items')
+    parser.add_argument('--documents', type=int, default=20000, help='random documents to compare')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-speedup', type=float, default=None, help='minimum speedup over the former _sub')
+    args = parser.parse_args()
+
+    different = check(args.documents)
+    print('{} of {} random documents differ from the former _sub'.format(len(different), args.documents))
+    for a, b in different[:5]:
+        print('  {!r} - {!r}'.format(a, b))
+
+    slower = []
+    for items in [int(items) for items in args.items.split(',')]:
+        a = {'x': [{'id': i} for i in range(items)], 'n': items}
+        b = {'x': [{'id': i} for i in range(0, items, 2)], 'n': 1}
+
+        current = measure(_sub, a, b, args.repeat)
+        previous = measure(previous_sub, a, b, args.repeat)
+        speedup = previous / current
+
+        print('items {:<6} _sub {:>8.1f} ms, former {:>8.1f} ms, {:.1f}x'.format(
+            items, current * 1000, previous * 1000, speedup))
+
+        if args.min_speedup is not None and speedup < args.min_speedup:
+            slower.append(items)
+
+    if slower:
+        print('Regression: _sub is less than {}x faster at {} items'.format(
+            args.min_speedup, ', '.join(map(str, slower))))
+
+    if different or slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
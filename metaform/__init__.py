@@ -1,18 +1,44 @@
 import importlib
-import json, yaml
+import io
+import json
 import os
 
-import metawiki
-import requests
-from boltons.iterutils import remap
-from metaform import converters
+from metaform import converters, rules, utils  # noqa
+from metaform.aligner import Aligner
+from metaform.compiled import CompiledSchema, Formatter, View, compile, field_tree, get_compiled, transform  # noqa
+from metaform.inference import Shape, infer, infer_shape  # noqa
+from metaform.parallel import chunked, normalize_parallel
+from metaform.profiling import callbacks, emit, instrument, stage, subscribe, unsubscribe  # noqa
+from metaform.records import Layouts, Row  # noqa
+from metaform.router import Router, schema_key
+from metaform.rules import RuleError, get_rule
+from metaform.stream import iter_json, iter_yaml
 # convenience alias #
-from metaform.utils import _add, _sub, dictget, get_concept, get_match_matrix, get_schema, metapath
+from metaform.utils import _add, _sub, dictget, get_concept, get_match_matrix, get_schema, metapath  # noqa
+from metaform.utils import Patch, diff  # noqa
 from metaform.utils import metaplate as template  # noqa
-from metaform.utils import slug
+from metaform.utils import configure, prefetch  # noqa
+from metaform.utils import save_term, slug
 
 to = converters
 
+# {name: (module, attribute)}, imported on first use (see __getattr__), rather
+# than with metaform, as most of the code paths do not need them.
+LAZY = {
+    'metawiki': ('metawiki', None),
+    'requests': ('requests', None),
+    'yaml': ('yaml', None),
+    'remap': ('boltons.iterutils', 'remap'),
+}
+
+
+def __getattr__(name):
+    if name in LAZY:
+        module, attribute = LAZY[name]
+        module = importlib.import_module(module)
+        return getattr(module, attribute) if attribute else module
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
 def convert(key, value, schema, slugify=False, namespace=False, storage=None):
     """
@@ -53,10 +79,11 @@ def convert(key, value, schema, slugify=False, namespace=False, storage=None):
         if '|' not in schema:
             schema += '|'
 
-        term, rules = schema.split('|')
+        term, rule = schema.split('|')
 
         if term:
             if namespace:
+                import metawiki
                 term = metawiki.url_to_name(term)
 
             if slugify:
@@ -64,17 +91,18 @@ def convert(key, value, schema, slugify=False, namespace=False, storage=None):
 
                 # Save the slugified key.
                 if storage:
-                    try:
-                        storage['types']['_terms'].insert(record)
-                    except BaseException:
-                        # Probaby, already exists.
-                        pass
+                    save_term(storage, record)
                 term = record['name']
 
-        if rules:
+        if rule:
             try:
-                value = eval(rules)(value)
+                value = get_rule(rule)(value)
+            except RuleError:
+                # Reported once, when the rule was evaluated.
+                pass
             except Exception as e:
+                if callbacks:
+                    emit('rule.errors', 1, {'rule': rule})
                 if not any([isinstance(value, t) for t in [list, tuple, dict]]):
                     print('Failed to convert value: {}'.format(value))
                     print(e)
@@ -86,6 +114,7 @@ def convert(key, value, schema, slugify=False, namespace=False, storage=None):
     return key, value
 
 
+@stage('normalize', schema=True)
 def normalize(data, schema=None, slugify=False, namespace=False, storage=None, refresh=False):
     '''
     Combine data with schema and types in schema by zipping tree.
@@ -112,7 +141,15 @@ def normalize(data, schema=None, slugify=False, namespace=False, storage=None, r
       'https-www-wikidata-org-wiki-q185836':
          {'https-www-wikidata-org-wiki-q185836#median': 12,
           'https-www-wikidata-org-wiki-q185836#average': 15}}]
+
+    The schema may also be a CompiledSchema (see metaform.compile), in which
+    case slugify, namespace and storage are the ones it was compiled with.
     '''
+    from boltons.iterutils import remap
+
+    if isinstance(schema, CompiledSchema):
+        return schema.normalize(data)
+
     if not schema or refresh:
         if '*' in data.keys():
             schema = get_schema(data['*'], refresh=refresh)
@@ -135,6 +172,49 @@ def normalize(data, schema=None, slugify=False, namespace=False, storage=None, r
     return remapped
 
 
+@stage('normalize_many', schema=True)
+def normalize_many(records, schema=None, slugify=False, namespace=False, storage=None, refresh=False,
+                   executor=None, workers=None, chunksize=1000, ordered=True):
+    '''
+    Normalizes a list of records sharing one schema, returning the same as:
+    >>> [normalize(record, schema) for record in records]
+
+    The schema is compiled once, and the values are converted path by path
+    (see CompiledSchema.normalize_many). Without a schema (or with refresh),
+    each record is normalized by the schema its '*' refers to.
+
+    With workers (or an executor, e.g., a ProcessPoolExecutor), records
+    are normalized in chunks of chunksize across processes (see
+    metaform.parallel), and returned in order, or as chunks finish, if not
+    ordered.
+    '''
+    if not schema or refresh:
+        # Records of mixed schemas, normalized by the schema of each group of the same '*'.
+        router = Router(schema, slugify=slugify, namespace=namespace, storage=storage, refresh=refresh,
+                        executor=executor, workers=workers, chunksize=chunksize)
+        return router.normalize(records)
+
+    if workers or executor:
+        return normalize_parallel(records, schema, {'slugify': slugify, 'namespace': namespace, 'storage': storage},
+                                  executor=executor, workers=workers, chunksize=chunksize, ordered=ordered)
+
+    compiled = compile(schema, slugify=slugify, namespace=namespace, storage=storage)
+    return compiled.normalize_many(records)
+
+
+def cache_stats():
+    '''
+    Returns statistics of the in-process caches, e.g.:
+    >>> cache_stats()['concepts']
+    {'hits': 499990, 'misses': 10, 'evictions': 0, 'maxsize': 10000, 'currsize': 10, 'ttl': 3600}
+    '''
+    return {
+        'rules': rules.cache.info()._asdict(),
+        'concepts': utils.concept_memo.info()._asdict(),
+    }
+
+
+@stage('translate')
 def translate(ndata, lang=None, refresh=False):
     '''
     Applies language conversion if available to the keys.
@@ -147,22 +227,13 @@ def translate(ndata, lang=None, refresh=False):
     '''
 
     if lang:
-        def visit(path, key, value):
-            concept = get_concept(key, refresh)
-
-            if concept:
-                if concept.get('aliases'):
-                    if concept['aliases'].get(lang):
-                        return concept['aliases'][lang][0], value
-
-            return key, value
-
-        return remap(ndata, visit=visit)
+        return transform(None, ndata, Formatter(formats=False, lang=lang, refresh=refresh))
 
     else:
         return ndata
 
 
+@stage('formatize')
 def formatize(ndata, ignore=[], no_convert=[]):
     '''
     Applies converters, if they match the name after hash.
@@ -174,30 +245,41 @@ def formatize(ndata, ignore=[], no_convert=[]):
 
     no_convert: list of types, not to apply conversion, e.g., ['url', 'decimal']
     '''
+    result = transform(None, ndata, Formatter(ignore=ignore, no_convert=no_convert))
 
-    def visit(path, key, value):
+    if isinstance(ndata, list):
+        result = List(result)
 
-        if isinstance(key, str):
-            if '#' in str(key)[1:-1:]:
-                if type(value) in [str, int, float]:
-                    Format = key.rsplit('#', 1)[-1]
-                    if hasattr(converters, Format) and Format not in no_convert:
-                        k = key.rsplit('#', 1)[0]
-                        v = getattr(converters, key.rsplit('#', 1)[-1])(value)
-                        if (k in ignore) or (key in ignore):
-                            return k, value
-                        return k, v
+    return result
 
-                return key.rsplit('#', 1)[0], value
 
-        return key, value
+def formatted(data, schema=None, lang=None, refresh=False, ignore=[], no_convert=[], formatter=None):
+    '''
+    Normalizes, formats and translates a record in one traversal (see
+    CompiledSchema.format), giving the same as:
+    >>> translate(formatize(normalize(data, schema), ignore, no_convert), lang, refresh)
+    '''
+    if formatter is None:
+        formatter = Formatter(lang=lang, refresh=refresh, ignore=ignore, no_convert=no_convert)
 
-    result = remap(ndata, visit=visit)
+    if not schema and '*' in data.keys():
+        schema = get_schema(data['*'])
 
-    if isinstance(ndata, list):
-        result = List(result)
+    if not schema:
+        return transform(None, normalize(data, schema=schema or {}), formatter)
 
-    return result
+    return get_compiled(schema).format(data, formatter=formatter)
+
+
+def projection(lang=None, refresh=False, anchors=True):
+    '''
+    Returns the Formatter, that gives the fields of records the same as
+    format(lang=lang, anchors=anchors) does.
+    '''
+    if lang:
+        return Formatter(lang=lang, refresh=refresh, no_convert=['url'])
+
+    return Formatter(formats=not anchors)
 
 
 class Dict(dict):
@@ -205,19 +287,50 @@ class Dict(dict):
     def __init__(self, *args, **kwargs):
         self.update(*args, **kwargs)
 
-    def format(self, schema=None, lang=None, refresh=False, anchors=True):
+    @stage('format', schema=True)
+    def format(self, schema=None, lang=None, refresh=False, anchors=True, fields=None):
+        '''
+        With fields (paths of source, or normalized keys, see View.project),
+        returns only them, converting nothing else, e.g.:
+        >>> Dict(topic).format(schema, fields=['title', ['owner', 'username']])
+        '''
 
         if isinstance(schema, str) and len(schema) <= 3:
             lang = schema
             schema = None
 
+        if fields is not None:
+            view = self.view(schema=schema, refresh=refresh, formatter=projection(lang, refresh, anchors))
+            return view.project(fields)
+
         if lang:
-            return translate(formatize(normalize(self, schema=schema), no_convert=['url']), lang=lang, refresh=refresh)
+            return formatted(self, schema=schema, lang=lang, refresh=refresh, no_convert=['url'])
 
         if anchors:
             return normalize(self, schema=schema, refresh=refresh)
-        else:
+        elif refresh:
             return formatize(normalize(self, schema=schema, refresh=refresh))
+        else:
+            return formatted(self, schema=schema)
+
+    def view(self, schema=None, lang=None, refresh=False, formatter=None):
+        '''
+        Returns a read-only mapping, equal to self.format(schema, lang,
+        anchors=False), that converts values only when their keys are
+        accessed (see metaform.compiled.View), e.g., to read a few fields
+        of a large record:
+        >>> Dict(document).view(schema)['title']
+        '''
+        if not schema and '*' in self.keys():
+            schema = get_schema(self['*'], refresh=refresh)
+
+        if formatter is None:
+            formatter = Formatter(lang=lang, refresh=refresh, no_convert=['url'] if lang else [])
+
+        if not schema:
+            return View(None, self, formatter)
+
+        return get_compiled(schema).view(self, formatter=formatter)
 
     def render(self, lang, schema=None, refresh=False):
         return translate(normalize(self, schema=schema), lang=lang, refresh=refresh)
@@ -225,12 +338,16 @@ class Dict(dict):
     def __add__(self, other):
         return _add(self, other)
 
+    def __iadd__(self, other):
+        return _add(self, other, inplace=True)
+
     def __sub__(self, other):
         return _sub(self, other)
 
     def start(self):
         ''' Initialize methods.
         TODO: To automate in __init__ later. '''
+        import metawiki
 
         url = self.get('-')
         schema = get_schema(self['*'])
@@ -284,28 +401,95 @@ class Dict(dict):
 
 class List(list):
 
-    def format(self, schema=None, lang=None, refresh=False, anchors=True):
+    @stage('format', schema=True)
+    def format(self, schema=None, lang=None, refresh=False, anchors=True, workers=None, chunksize=1000, fields=None,
+               compact=False):
+        '''
+        With workers, records are normalized across a pool of processes
+        (see normalize_many). With fields, only the fields are normalized
+        (see Dict.format).
+
+        With compact=True, records (and dicts in them) are read-only rows,
+        that share the tuples of their keys (see metaform.records), e.g.,
+        to keep millions of records in memory.
+        '''
 
         if isinstance(schema, str) and len(schema) <= 3:
             lang = schema
             schema = None
 
-        if lang:
-            return translate(formatize([normalize(item, schema=schema)
-                                        for item in self], no_convert=['url']), lang=lang, refresh=refresh)
+        layouts = Layouts() if compact else None
 
-        if anchors:
-            return [normalize(item, schema=schema, refresh=refresh) for item in self]
+        def rows(records):
+            # Compacted one by one, as they are formatted.
+            return List(map(layouts.compact, records) if compact else records)
+
+        def batched(function):
+            # Compacted chunk by chunk, so that only chunksize records are
+            # ever kept as dicts (in a pool of workers, all of them are).
+            if compact and not workers:
+                return rows(record for chunk in chunked(self, chunksize) for record in function(chunk))
+
+            result = function(self)
+            return rows(result) if compact else result
+
+        if fields is not None:
+            formatter = projection(lang, refresh, anchors)
+            tree = field_tree(fields)
+            return rows(
+                Dict.view(record, schema=schema, refresh=refresh, formatter=formatter).project(tree)
+                for record in self
+            )
+
+        parallel = {'workers': workers, 'chunksize': chunksize}
+
+        if not schema or refresh:
+            # The same as normalize_many() does, but one router for all the chunks.
+            router = Router(schema, refresh=refresh, workers=workers, chunksize=chunksize)
+            normalize_records = router.normalize
         else:
-            return formatize([normalize(item, schema=schema, refresh=refresh) for item in self])
+            def normalize_records(records):
+                return normalize_many(records, schema=schema, **parallel)
+
+        if anchors and not lang:
+            return batched(normalize_records)
+
+        if lang:
+            formatter = Formatter(lang=lang, refresh=refresh, no_convert=['url'])
+        elif refresh:
+            return batched(lambda records: formatize(normalize_records(records)))
+        else:
+            formatter = Formatter()
+
+        if workers:
+            return rows(transform(None, normalize_many(self, schema=schema, **parallel), formatter))
+
+        if not schema:
+            router = Router(schema)
+            return batched(lambda records: router.format(records, formatter=formatter))
+
+        # Normalized, formatted and translated in one traversal, and keys resolved once for all records.
+        compiled = get_compiled(schema)
+        return rows(formatted(record, schema=compiled, formatter=formatter) for record in self)
 
     def render(self, lang, schema=None, refresh=False):
-        return translate([normalize(item, schema=schema) for item in self], lang=lang, refresh=refresh)
+        return translate(normalize_many(self, schema=schema), lang=lang, refresh=refresh)
+
+    def normalize(self, refresh=False, by_record=None):
+        '''
+        Normalizes the records by the schema of each (their '*'), or by the
+        schema of the record at by_record, for all of them. Records without
+        '*' are normalized by the schema of the first record.
+        '''
+        if by_record is None:
+            router = Router(refresh=refresh)
+            if self:
+                router.schema = router.resolve(schema_key(self[0]))
+            return router.normalize(self)
 
-    def normalize(self, refresh=False, by_record=0):
         schema_name = self[by_record].get('*')
-        schema = get_schema(schema_name)
-        return [normalize(item, schema=schema) for item in self]
+        schema = get_schema(schema_name, refresh=refresh)
+        return normalize_many(self, schema=schema)
 
 
 def wrap(records: list, schema: dict):
@@ -325,9 +509,12 @@ def load(data, schema=None):
     '''
 
     if isinstance(data, str):
+        import metawiki
 
         # Probing if it is a URL
         if data.startswith('http://') or data.startswith('https://') or data.startswith('ftp://'):
+            import requests
+
             filename = data.rsplit('/', 1)[-1]
 
             if schema is None:
@@ -352,6 +539,7 @@ def load(data, schema=None):
             fsource = open(data, 'r')
 
             if filename.endswith('.yaml') or filename.endswith('.yml'):
+                import yaml
 
                 try:
                     loader = yaml.CLoader
@@ -383,18 +571,89 @@ def load(data, schema=None):
         return ndata
 
 
+def iterload(source, schema=None):
+    '''
+    Streams records from a data source, like load() reads them, but one at
+    a time: JSON arrays are parsed incrementally, NDJSON line by line, YAML
+    document by document, and each record is wrapped (and normalized, if
+    there is a schema) only when it is reached.
+
+    Examples:
+    >>> for record in iterload('export.ndjson', schema=schema):
+    ...     process(record)
+    '''
+
+    if isinstance(source, str):
+        import metawiki
+
+        # Probing if it is a URL
+        if source.startswith('http://') or source.startswith('https://') or source.startswith('ftp://'):
+            import requests
+
+            filename = source.rsplit('/', 1)[-1]
+            response = requests.get(source, stream=True)
+            response.raw.decode_content = True
+            fsource = io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8')
+
+        # Probing if it is a local path
+        elif len(source[:4096]) < 4096 and os.path.exists(source):
+            filename = source.rsplit('/', 1)[-1]
+            fsource = open(source, 'r')
+
+        else:
+            raise Exception("Unidentified string format. Pass a string, dict, or list")
+
+        if schema is None:
+            try:
+                schema = metawiki.fn2url(filename)
+            except Exception:
+                schema = None
+
+        if filename.endswith('.yaml') or filename.endswith('.yml'):
+            records = iter_yaml(fsource)
+        else:
+            records = iter_json(fsource)
+
+    else:
+        fsource = None
+        records = [source] if isinstance(source, dict) else source
+
+    if schema:
+        # the same as wrap(), record by record
+        compiled = compile([schema])
+
+    try:
+        for record in records:
+            if schema:
+                record = compiled.normalize([record])[0]
+            yield Dict(record) if isinstance(record, dict) else record
+    finally:
+        if fsource is not None:
+            fsource.close()
+
+
 def dump():
     pass
 
 
-def read_csv(path, schema=None, refresh=False, *args, **kwargs):
+def read_csv(path, schema=None, refresh=False, *args, chunksize=None, **kwargs):
+    '''
+    Reads a CSV file with pandas, renaming and converting its columns by
+    schema (or the schema named by its filename).
+
+    With chunksize, yields the converted DataFrames of chunksize rows:
+    >>> for df in read_csv('keylog.csv', schema=schema, chunksize=100000):
+    ...     process(df)
+    '''
 
     try:
         from pandas import read_csv as p_read_csv
     except Exception:
         print("This command uses pandas, pip install pandas to use it.")
+        return
 
     if schema is None:
+        import metawiki
 
         try:
 
@@ -402,10 +661,7 @@ def read_csv(path, schema=None, refresh=False, *args, **kwargs):
                 fn = path.rsplit('/', 1)[-1]
 
             elif len(path[:4096]) < 4096 and os.path.exists(path):
-                if '/' in path:
-                    fn = fn.rsplit('/', 1)[-1]
-                else:
-                    fn = path
+                fn = path.rsplit('/', 1)[-1]
 
             schema_url = metawiki.fn2url(fn)
             schema = get_schema(schema_url, refresh=refresh)
@@ -420,64 +676,84 @@ def read_csv(path, schema=None, refresh=False, *args, **kwargs):
             print("Pass it, like read_csv(path, schema=schema)")
 
     if schema is not None:
-        df = p_read_csv(path, *args, **kwargs)
 
-        df.rename(columns={
-            key: (isinstance(schema[key], dict) and schema[key].get('*').rsplit('|', 1)[0]) or
-                 (isinstance(schema[key], str) and schema[key].rsplit('|', 1)[0])
-            for key in df.columns if key in schema and key != '*'
-        }, inplace=True)
+        if chunksize:
+            return (
+                convert_frame(df, schema, verbose=(i == 0))
+                for i, df in enumerate(p_read_csv(path, *args, chunksize=chunksize, **kwargs))
+            )
 
-        started = False
-        for key in schema:
-            if key == '*':
-                if schema['*'] is not None:
-                    df.index.name = schema['*']
+        return convert_frame(p_read_csv(path, *args, **kwargs), schema)
 
-            if isinstance(schema[key], dict):
-                spec = schema[key].get('*')
-            elif isinstance(schema[key], str):
-                spec = schema[key]
 
-            if '|' in spec:
-                term, rules = spec.rsplit('|')
+def convert_frame(df, schema, verbose=True):
+    '''
+    Renames the columns of a pandas DataFrame to the terms of schema, and
+    converts them by its rules, a column at a time (see converters.vectorized).
+    '''
+
+    df.rename(columns={
+        key: (isinstance(schema[key], dict) and schema[key].get('*').rsplit('|', 1)[0]) or
+             (isinstance(schema[key], str) and schema[key].rsplit('|', 1)[0])
+        for key in df.columns if key in schema and key != '*'
+    }, inplace=True)
+
+    started = False
+    for key in schema:
+        if key == '*':
+            if schema['*'] is not None:
+                df.index.name = schema['*']
+
+        if isinstance(schema[key], dict):
+            spec = schema[key].get('*')
+        elif isinstance(schema[key], str):
+            spec = schema[key]
+        else:
+            continue
 
-                if term in df.columns:
+        if spec and '|' in spec:
+            term, rule = spec.rsplit('|')
+
+            if term in df.columns:
+                try:
+                    function = get_rule(rule)
+                except RuleError:
+                    continue
+
+                if verbose:
                     if not started:
                         print("Converting fields ...")
                         started = True
 
-                    print("%s: %s" % (term, rules))
-                    df.loc[:, term] = df[term].apply(lambda x: eval(rules)(x))
+                    print("%s: %s" % (term, rule))
 
-        return df
+                df[term] = converters.vectorized(function, df[term])
 
+    return df
 
-def align(source_list, key_list=None):
+
+def align(source_list, key_list=None, sample=1, output='records', backend='array'):
     '''
     [Accepts:]
     source_list: list of lists or generators for records
-    schema_list: list of schemas of each source
     key_list: list of keys of interest
+    sample: number of first records of each source to match the fields by
 
     [Returns:]
-    a single list or generator, that only has fields selected,
-    no matter what depth the fields were found in
+    a generator of records, that only have the fields found in all the
+    sources (or of key_list), no matter what depth the fields were found
+    in (None, where a record does not have it). See metaform.aligner.
+
+    With output='columns', returns them as {field: column} instead, where
+    columns are typed arrays, or lists (see Aligner.columns for backend).
 
     >>> metaform.align([[{'a': {'c': 'X'}, 'n': 1}], [{'b': {'a': {'c': 'Y'}}, 'd': {'n': 2}}]], key_list=None)
     '''
+    aligner = Aligner(source_list, key_list=key_list, sample=sample)
 
-    # matching based on shape of first record
-    matching = get_match_matrix(
-        [source[0] for source in source_list])
-
-    # (the more sources, it might be less shared fields that can be matched)
+    if output == 'columns':
+        return aligner.columns(backend=backend)
+    if output != 'records':
+        raise ValueError("Unknown output: {} (expected 'records' or 'columns')".format(output))
 
-    # get values by depth and source id
-    for i, source in enumerate(source_list):
-        for item in source:
-            record = {
-                key: dictget(item, matching[key][i])
-                for key in matching
-            }
-            yield record
+    return iter(aligner)
@@ -0,0 +1,270 @@
+'''
+Alignment of records from several sources to the fields they share, no
+matter what depth the fields are found in.
+
+The paths of the fields are inferred once, from a sample of records of
+each source, and compiled into an accessor function per source, so that
+aligning a record is a few subscripts, rather than a dictget() per field:
+
+>>> aligner = Aligner([topics, comments], sample=100)
+>>> aligner.matching
+{'id': [['id'], ['id']], 'username': [['owner', 'username'], ['some', 'place', 'deep', 'username']]}
+>>> for record in aligner:
+...     process(record)
+
+Or, aligned into columns, without building a dict per record:
+>>> aligner.columns()
+{'id': array('q', [1, 2, ...]), 'username': ['max', 'dim', ...]}
+'''
+import json
+from array import array
+from collections import Counter
+from itertools import chain, islice
+
+from metaform.utils import get_concept_paths
+
+LOOKUP_ERRORS = (KeyError, IndexError, TypeError)
+
+CHUNKSIZE = 65536
+
+# {array typecode: numpy dtype}
+DTYPES = {'q': 'int64', 'd': 'float64'}
+
+BACKENDS = ('array', 'numpy', 'arrow')
+
+
+def get_path(record, path):
+    '''
+    Returns the value at path of record, or None, if there is none.
+    '''
+    try:
+        for key in path:
+            record = record[key]
+        return record
+    except LOOKUP_ERRORS:
+        return None
+
+
+def infer_paths(records, exclude=[dict, list]):
+    '''
+    Returns {field: path} of the records, where path is the most common
+    path of the field (the first found, if as common).
+    '''
+    counts = {}
+
+    for record in records:
+        for field, paths in get_concept_paths(record, exclude=exclude).items():
+            counts.setdefault(field, Counter())[tuple(paths[0])] += 1
+
+    return {field: list(paths.most_common(1)[0][0]) for field, paths in counts.items()}
+
+
+def accessor(fields, paths, container='dict'):
+    '''
+    Compiles a function of a record to the {field: value} dict (or, with
+    container='tuple', the tuple of values) at paths, with None for the
+    values missing from the record.
+    '''
+    namespace = {}
+    values = []
+
+    for i, path in enumerate(paths):
+        subscripts = []
+        for j, key in enumerate(path):
+            namespace['k{}_{}'.format(i, j)] = key
+            subscripts.append('[k{}_{}]'.format(i, j))
+        namespace['f{}'.format(i)] = fields[i]
+        values.append('record' + ''.join(subscripts))
+
+    if container == 'tuple':
+        fast = eval('lambda record: ({})'.format(''.join(value + ', ' for value in values)), namespace)
+
+        def slow(record):
+            return tuple(get_path(record, path) for path in paths)
+    else:
+        fast = eval('lambda record: {{{}}}'.format(
+            ', '.join('f{}: {}'.format(i, value) for i, value in enumerate(values))), namespace)
+
+        def slow(record):
+            return {field: get_path(record, path) for field, path in zip(fields, paths)}
+
+    def access(record):
+        try:
+            return fast(record)
+        except LOOKUP_ERRORS:
+            return slow(record)
+
+    return access
+
+
+def extend(column, values):
+    '''
+    Extends column by values, where column is None (no values yet), an
+    array of integers ('q'), or floats ('d'), or a list (other values).
+    Returns the column, converted to a wider one, if values do not fit it.
+    '''
+    types = set(map(type, values))
+
+    if types <= {int}:
+        typecode = 'q'
+    elif types <= {int, float}:
+        typecode = 'd'
+    else:
+        typecode = None
+
+    if column is None:
+        column = array(typecode) if typecode else []
+
+    if isinstance(column, array):
+        if typecode is None:
+            column = column.tolist()
+        elif typecode == 'd' and column.typecode == 'q':
+            column = array('d', column)
+
+    if isinstance(column, array):
+        try:
+            column.extend(array(column.typecode, values))
+        except OverflowError:
+            column = column.tolist()
+            column.extend(values)
+    else:
+        column.extend(values)
+
+    return column
+
+
+def to_numpy(column):
+    import numpy
+
+    if isinstance(column, array):
+        return numpy.frombuffer(column, dtype=DTYPES[column.typecode])
+    return numpy.array(column, dtype=object)
+
+
+def to_string(value):
+    '''
+    Returns value as a string for a column of strings: dicts and lists (or,
+    tuples) as JSON, and anything else, also in them, as str(value).
+    '''
+    if isinstance(value, (dict, list, tuple)):
+        try:
+            return json.dumps(value, default=str)
+        except (TypeError, ValueError):
+            # E.g., keys that are not strings, or numbers.
+            pass
+
+    return str(value)
+
+
+def to_arrow_array(column):
+    '''
+    Returns the pyarrow array of column, or of its values as strings (None
+    kept, and dicts and lists as JSON, see to_string), if they are of
+    types, that no arrow type holds all of (e.g., numbers and strings).
+    '''
+    import pyarrow
+
+    if isinstance(column, array):
+        try:
+            return pyarrow.array(to_numpy(column))
+        except ImportError:
+            return pyarrow.array(column.tolist())
+
+    try:
+        return pyarrow.array(column)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+        return pyarrow.array([None if value is None else to_string(value) for value in column], type=pyarrow.string())
+
+
+def to_arrow(columns):
+    import pyarrow
+
+    return pyarrow.table({field: to_arrow_array(column) for field, column in columns.items()})
+
+
+class Aligner:
+    '''
+    Aligns the records of sources (lists or iterables) to the fields found
+    in the sampled records of all of them (or to the ones of key_list).
+
+    sample: number of first records of each source to infer the paths from.
+    '''
+
+    def __init__(self, sources, key_list=None, sample=1, exclude=[dict, list]):
+        self.sources = []
+        self.samples = []
+
+        for source in sources:
+            if isinstance(source, list):
+                head = source[:sample]
+            else:
+                source = iter(source)
+                head = list(islice(source, sample))
+                source = chain(head, source)
+            self.sources.append(source)
+            self.samples.append(head)
+
+        shapes = [infer_paths(head, exclude=exclude) for head in self.samples]
+
+        # Sources without records do not narrow the fields.
+        common = [shape for shape, head in zip(shapes, self.samples) if head]
+        if common:
+            fields = [field for field in common[0] if all(field in shape for shape in common[1:])]
+        else:
+            fields = []
+
+        if key_list is not None:
+            fields = [key for key in key_list if key in fields]
+
+        self.fields = fields
+        self.matching = {field: [shape.get(field) for shape in shapes] for field in fields}
+        self.paths = [[shape.get(field) or [] for field in fields] for shape in shapes]
+
+    def accessors(self, container='dict'):
+        return [accessor(self.fields, paths, container=container) for paths in self.paths]
+
+    def __iter__(self):
+        for source, access in zip(self.sources, self.accessors()):
+            yield from map(access, source)
+
+    def columns(self, backend='array', chunksize=CHUNKSIZE):
+        '''
+        Returns the aligned records as {field: column}, where a column is an
+        array of integers ('q'), or of floats ('d'), if all its values are,
+        or else a list. The records are read in chunks of chunksize, and the
+        values of a chunk are appended to the columns, so no dict is built
+        per record.
+
+        backend='numpy' returns numpy arrays (of dtype object, for lists),
+        and backend='arrow' returns a pyarrow.Table, if installed, where the
+        columns of mixed types (e.g., numbers and strings) are strings, that
+        is lossy: numbers, or dates come back as their str(), and dicts and
+        lists as JSON, e.g., [{'d': 1}, 'e', 2] as ['{"d": 1}', 'e', '2'].
+        Columns of dicts only are structs, and of lists only, lists.
+        '''
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: {} (expected one of {})'.format(backend, ', '.join(BACKENDS)))
+
+        columns = [None] * len(self.fields)
+
+        for source, access in zip(self.sources, self.accessors(container='tuple')):
+            source = iter(source)
+            while True:
+                rows = list(map(access, islice(source, chunksize)))
+                if not rows:
+                    break
+                for i, values in enumerate(zip(*rows)):
+                    columns[i] = extend(columns[i], values)
+
+        columns = {field: [] if column is None else column for field, column in zip(self.fields, columns)}
+
+        try:
+            if backend == 'numpy':
+                return {field: to_numpy(column) for field, column in columns.items()}
+            if backend == 'arrow':
+                return to_arrow(columns)
+        except ImportError:
+            package = 'pyarrow' if backend == 'arrow' else backend
+            print('This option uses {0}, pip install {0} to use it.'.format(package))
+
+        return columns
@@ -0,0 +1,420 @@
+'''
+Local cache of schemas and concepts, keyed by the slug of their URL.
+
+Every store has a keyed index, so that looking up a slug does not scan
+(or parse) the whole cache:
+
+    - MemoryStore: a dict,
+    - SqliteStore: a table of {slug: JSON} in ~/.metaform/cache.sqlite3,
+    - CachedStore: a MemoryStore in front of another store.
+
+The stores are pluggable, e.g.:
+>>> metaform.utils.concepts = MemoryStore()
+
+Memo is a bounded in-process LRU with expiry, used in front of the lookups,
+that happen for every key of every record (e.g., get_concept in translate).
+
+The former TinyDB files (~/.metaform/schemas.json, ~/.metaform/concepts.json)
+are migrated into the SQLite store when its table is first created.
+
+The cache directory and mode are in settings (see metaform.configure), and
+default to the METAFORM_CACHE_DIR and METAFORM_CACHE_MODE variables:
+
+    - readwrite: the SQLite store, created if missing (the default),
+    - readonly: the SQLite store opened immutable and memory-mapped (e.g.,
+      a snapshot built into an image), with lookups fetched at runtime kept
+      in the process,
+    - memory: a MemoryStore, preloaded from the SQLite store, if any.
+'''
+import abc
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not POSIX, so fetches are deduplicated within a process only.
+    fcntl = None
+
+conf_path = os.path.join(str(pathlib.Path.home()), '.metaform')
+
+MISSING = object()
+
+MODES = ('readwrite', 'readonly', 'memory')
+
+# Memory-mapped size of readonly SQLite stores.
+MMAP_SIZE = 2 ** 30
+
+# Seconds to wait for another process writing to a SQLite store.
+TIMEOUT = 60
+
+# Number of lock files (keys are hashed into them).
+LOCK_BUCKETS = 256
+
+
+def get_settings(environ=os.environ):
+    '''
+    Returns the cache settings of the environment variables.
+    '''
+    mode = environ.get('METAFORM_CACHE_MODE') or 'readwrite'
+
+    if mode not in MODES:
+        print('Unknown METAFORM_CACHE_MODE: {}, using readwrite.'.format(mode))
+        mode = 'readwrite'
+
+    return {'cache_dir': environ.get('METAFORM_CACHE_DIR') or conf_path, 'mode': mode}
+
+
+settings = get_settings()
+
+MemoInfo = namedtuple('MemoInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize', 'ttl'])
+
+
+class Store(abc.ABC):
+    '''
+    Interface of the cache stores.
+    '''
+
+    @abc.abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    @abc.abstractmethod
+    def keys(self):
+        pass
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class MemoryStore(Store):
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def keys(self):
+        return list(self.data.keys())
+
+
+class SqliteStore(Store):
+    '''
+    Table of {key: JSON value} in a SQLite database file.
+
+    Writes are transactions, so concurrent processes do not lose or corrupt
+    entries (they wait up to TIMEOUT seconds for each other). The journal is
+    the default rollback one, rather than a write-ahead log, so that the
+    file is complete by itself (e.g., for readonly snapshots).
+
+    With readonly=True, the file is opened immutable (so, without locking
+    it) and memory-mapped, and a missing table reads as empty.
+    '''
+
+    def __init__(self, path, table, readonly=False):
+        import sqlite3
+
+        self.path = path
+        self.table = table
+        self.readonly = readonly
+        self.created = False
+        self._lock = threading.Lock()
+
+        if readonly:
+            uri = '{}?mode=ro&immutable=1'.format(pathlib.Path(os.path.abspath(path)).as_uri())
+            self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._connection.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+            exists = self._connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            if not exists:
+                self._connection.execute('CREATE TEMP TABLE "{}" (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+            return
+
+        self._connection = sqlite3.connect(path, timeout=TIMEOUT, check_same_thread=False)
+
+        with self._lock, self._connection:
+            exists = self._connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            if not exists:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT)'.format(table))
+                self.created = True
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM "{}" WHERE key = ?'.format(self.table), (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self.table),
+                (key, json.dumps(value)))
+
+    def update(self, items):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self.table),
+                [(key, json.dumps(value)) for key, value in items])
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM "{}" WHERE key = ?'.format(self.table), (key,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM "{}"'.format(self.table))
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute('SELECT key FROM "{}"'.format(self.table))]
+
+    def items(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT key, value FROM "{}"'.format(self.table)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM "{}"'.format(self.table)).fetchone()[0]
+
+
+class CachedStore(Store):
+    '''
+    In-process dict in front of another store. With readonly=True, the
+    writes are kept in the dict only.
+    '''
+
+    def __init__(self, store, readonly=False):
+        self.store = store
+        self.readonly = readonly
+        self.front = {}
+
+    def get(self, key, default=None):
+        value = self.front.get(key, MISSING)
+        if value is MISSING:
+            value = self.store.get(key, MISSING)
+            if value is MISSING:
+                return default
+            self.front[key] = value
+        return value
+
+    def set(self, key, value):
+        if not self.readonly:
+            self.store.set(key, value)
+        self.front[key] = value
+
+    def delete(self, key):
+        if not self.readonly:
+            self.store.delete(key)
+        self.front.pop(key, None)
+
+    def clear(self):
+        if not self.readonly:
+            self.store.clear()
+        self.front.clear()
+
+    def keys(self):
+        if self.readonly:
+            return list(set(self.store.keys()) | set(self.front))
+        return self.store.keys()
+
+    def __len__(self):
+        if self.readonly:
+            return len(self.keys())
+        return len(self.store)
+
+
+# Thread locks of the lock files, so that threads of a process wait for
+# each other, rather than for the lock file (keys of a bucket share both).
+_key_locks = [threading.Lock() for _ in range(LOCK_BUCKETS)]
+
+
+@contextmanager
+def lock(key, path=None):
+    '''
+    Holds the lock of key, so that one thread (and, with the cache directory
+    path, one process) at a time does what it guards, e.g., fetches a URL,
+    while the others wait:
+    >>> with lock(slug, settings['cache_dir']):
+    ...     value = store.get(slug) or fetch(url)
+
+    Keys are hashed into LOCK_BUCKETS locks, so the block must not take
+    the lock of another key.
+    '''
+    bucket = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % LOCK_BUCKETS
+
+    with _key_locks[bucket]:
+        if path is None or fcntl is None:
+            yield
+            return
+
+        directory = os.path.join(path, 'locks')
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, '{}.lock'.format(bucket)), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Memo:
+    '''
+    Bounded LRU of {key: value}, where values expire ttl seconds after they
+    were set (ttl=None never expires). None values are kept, so that the
+    keys known not to resolve (negative results) are not looked up again.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self._lock:
+            return MemoInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._items), self.ttl)
+
+
+def migrate(path, store, field):
+    '''
+    Copies the records of a TinyDB JSON file, e.g.:
+    {"_default": {"1": {"slug": "...", "schema": {...}}}}
+    into the store, as {slug: record[field]}. Returns the number of records.
+    '''
+    try:
+        with open(path, 'r') as f:
+            tables = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    items = {}
+    for table in tables.values():
+        for record in table.values():
+            # TinyDB search returned the first inserted record for a slug.
+            if 'slug' in record and record['slug'] not in items:
+                items[record['slug']] = record.get(field)
+
+    if hasattr(store, 'update'):
+        store.update(items.items())
+    else:
+        for key, value in items.items():
+            store.set(key, value)
+
+    return len(items)
+
+
+def open_store(name, field, path=None, mode=None):
+    '''
+    Opens the {slug: field} store called name (e.g., 'schemas', 'schema')
+    in the cache directory path, in mode (see MODES), by default the ones
+    in settings. In readwrite mode, migrates the former TinyDB file of the
+    same name, if any.
+    '''
+    path = path or settings['cache_dir']
+    mode = mode or settings['mode']
+    filename = os.path.join(path, 'cache.sqlite3')
+
+    if mode == 'memory':
+        if not os.path.exists(filename):
+            return MemoryStore()
+        store = SqliteStore(filename, name, readonly=True)
+        data = dict(store.items())
+        store.close()
+        return MemoryStore(data)
+
+    if mode == 'readonly':
+        if not os.path.exists(filename):
+            print('-> No cache at {}, caching in memory.'.format(filename))
+            return MemoryStore()
+        return CachedStore(SqliteStore(filename, name, readonly=True), readonly=True)
+
+    os.makedirs(path, exist_ok=True)
+
+    # So that one process creates the table, and migrates into it.
+    with lock(filename, path):
+        store = SqliteStore(filename, name)
+
+        if store.created:
+            migrate(os.path.join(path, '{}.json'.format(name)), store, field)
+
+    return CachedStore(store)
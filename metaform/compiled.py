@@ -0,0 +1,755 @@
+'''
+Compiled schemas.
+
+A schema is resolved once into a tree of nodes, where every node carries the
+pre-parsed rule (renamed key, converter callable) for its path, so that
+normalizing a record does no 'term|rules' parsing, no eval and no schema
+traversal per value.
+
+Example:
+>>> schema = {'hello': {'*': 'length|lambda x: x+5.'}}
+>>> compiled = compile(schema)
+>>> compiled.normalize({'hello': 1.0})
+{'length': 6.0}
+
+It also formats (see formatize) and translates (see translate) records in
+the same traversal, that normalizes them:
+>>> compiled.format({'hello#integer': '1'})
+{'hello': 1}
+'''
+from collections import defaultdict
+from collections.abc import Mapping, Sequence, Set
+
+from metaform import converters
+from metaform.cache import Memo
+from metaform.profiling import callbacks, emit
+from metaform.rules import RuleError, get_rule
+from metaform.utils import get_concept, save_term, slug
+
+# {repr(schema): CompiledSchema}, see get_compiled()
+compiled_memo = Memo(maxsize=256, ttl=None)
+
+
+class Rule:
+    '''
+    Pre-resolved conversion of a single schema path.
+    '''
+
+    def __init__(self, term=None, function=None, source=None):
+        self.term = term
+        self.function = function
+        self.source = source
+
+    def __call__(self, key, value):
+        if self.function is not None:
+            try:
+                value = self.function(value)
+            except Exception as e:
+                if callbacks:
+                    emit('rule.errors', 1, {'rule': self.source})
+                if not isinstance(value, (list, tuple, dict)):
+                    print('Failed to convert value: {}'.format(value))
+                    print(e)
+
+        if self.term:
+            key = self.term
+
+        return key, value
+
+    def __repr__(self):
+        return 'Rule({!r}, {!r})'.format(self.term, self.source)
+
+
+class Node:
+    '''
+    Schema at one metapath: the rule for it, and the nodes below it.
+    '''
+
+    def __init__(self, rule=None, depth=0):
+        self.rule = rule
+        self.depth = depth
+        self.children = {}
+        # If the rule of any child renames its key.
+        self.renames = False
+
+
+class Formatter:
+    '''
+    Changes, that formatize() and translate() make to the keys (and values)
+    of mappings, resolved once per key: the '#format' suffix removed and its
+    converter applied to the value, and the key replaced by its alias in lang.
+    '''
+
+    def __init__(self, formats=True, lang=None, refresh=False, ignore=[], no_convert=[]):
+        self.formats = formats
+        self.lang = lang
+        self.refresh = refresh
+        self.ignore = ignore
+        self.no_convert = no_convert
+        self.resolved = {}
+
+    def resolve(self, key):
+        function = None
+        ignored = False
+
+        if self.formats and isinstance(key, str) and '#' in key[1:-1]:
+            name, Format = key.rsplit('#', 1)
+            if Format not in self.no_convert:
+                function = getattr(converters, Format, None)
+            ignored = (name in self.ignore) or (key in self.ignore)
+            key = name
+
+        if self.lang and not isinstance(key, int):
+            concept = get_concept(key, self.refresh)
+            if concept and concept.get('aliases') and concept['aliases'].get(self.lang):
+                key = concept['aliases'][self.lang][0]
+
+        return key, function, ignored
+
+    def get(self, key):
+        try:
+            return self.resolved[key]
+        except KeyError:
+            resolved = self.resolved[key] = self.resolve(key)
+            return resolved
+
+    def key(self, key):
+        return self.get(key)[0]
+
+    def __call__(self, key, value):
+        key, function, ignored = self.get(key)
+
+        if function is not None and not ignored and type(value) in (str, int, float):
+            if callbacks and hasattr(function, 'many'):
+                # The same as silent, but counting the values, that failed.
+                try:
+                    value = function(value, silent=False)
+                except Exception:
+                    emit('converter.errors', 1, {'key': key, 'format': function.__name__})
+            else:
+                value = function(value)
+
+        return key, value
+
+
+def compile_rule(meta, slugify=False, namespace=False, storage=None):
+    '''
+    Resolves a schema entry (e.g., {'*': 'term|rules'} or 'term|rules')
+    into a Rule, mirroring convert(). Returns None, if it does nothing.
+    '''
+    if isinstance(meta, list):
+        if not meta:
+            return
+        meta = meta[0]
+
+    if isinstance(meta, dict):
+        if '*' not in meta.keys():
+            return
+        meta = meta.get('*')
+    elif not isinstance(meta, str):
+        return
+
+    if not meta or not isinstance(meta, str):
+        return
+
+    if '|' not in meta:
+        meta += '|'
+
+    try:
+        term, rules = meta.split('|')
+    except ValueError:
+        return
+
+    if term:
+        if namespace:
+            import metawiki
+
+            try:
+                term = metawiki.url_to_name(term)
+            except BaseException:
+                return
+
+        if slugify:
+            record = {'name': slug(term), 'url': term}
+
+            # Save the slugified key.
+            if storage:
+                save_term(storage, record)
+            term = record['name']
+
+    function = None
+
+    if rules:
+        try:
+            function = get_rule(rules)
+        except RuleError:
+            # Reported once by the rule cache, values are left as they are.
+            pass
+
+    if not term and function is None:
+        return
+
+    return Rule(term or None, function, rules or None)
+
+
+class CompiledSchema:
+    '''
+    Schema resolved into a reusable normalizer.
+
+    Gives the same results as normalize(data, schema) with the same
+    slugify, namespace and storage options.
+    '''
+
+    def __init__(self, schema, slugify=False, namespace=False, storage=None):
+        self.schema = schema
+        self.slugify = slugify
+        self.namespace = namespace
+        self.table = {}
+        self.options = {'slugify': slugify, 'namespace': namespace, 'storage': storage}
+        self._characters = {}
+        self.root = self._compile(schema, (), root=True)
+
+    def _compile(self, schema, path, root=False):
+
+        character = isinstance(schema, str) and len(schema) == 1 and not root
+
+        if character:
+            # Indexing a character gives itself, so reuse nodes to end recursion.
+            if schema in self._characters:
+                return self._characters[schema]
+
+        node = Node(None if root else compile_rule(schema, **self.options), len(path))
+
+        if character:
+            self._characters[schema] = node
+
+        if not root:
+            self.table[path] = node.rule
+
+        if isinstance(schema, dict):
+            for key, value in schema.items():
+                node.children[key] = self._compile(value, path + (key,))
+
+        elif isinstance(schema, (list, tuple, str)) and schema:
+            node.children[0] = self._compile(schema[0], path + (0,))
+
+        node.renames = any(child.rule is not None and child.rule.term for child in node.children.values())
+
+        return node
+
+    def normalize(self, data):
+        '''
+        Normalizes a single record (or a list of them, if schema is a list).
+        '''
+        remapped = remap(self.root, data)
+
+        if isinstance(remapped, dict) and isinstance(self.schema, dict):
+            if self.schema.get('*') in remapped:
+                remapped['*'] = remapped.pop(self.schema.get('*'))
+                remapped['*'] = self.schema.get('*')
+
+        return remapped
+
+    __call__ = normalize
+
+    def format(self, data, lang=None, refresh=False, ignore=[], no_convert=[], formatter=None):
+        '''
+        Normalizes, formats and translates a record in one traversal, giving
+        the same as:
+        >>> translate(formatize(compiled.normalize(data), ignore, no_convert), lang, refresh)
+
+        A formatter (see Formatter) can be shared between records, so that
+        keys are resolved once for all of them.
+        '''
+        if formatter is None:
+            formatter = Formatter(lang=lang, refresh=refresh, ignore=ignore, no_convert=no_convert)
+
+        star = self.schema.get('*') if isinstance(self.schema, dict) else None
+
+        return transform(self.root, data, formatter, star=star)
+
+    def view(self, data, lang=None, refresh=False, ignore=[], no_convert=[], formatter=None):
+        '''
+        Returns a read-only View of a record, that gives the same as format()
+        for the keys accessed, converting their values on first access.
+        '''
+        if formatter is None:
+            formatter = Formatter(lang=lang, refresh=refresh, ignore=ignore, no_convert=no_convert)
+
+        star = self.schema.get('*') if isinstance(self.schema, dict) else None
+
+        return View(self.root, data, formatter, star=star)
+
+    def normalize_many(self, records):
+        '''
+        Normalizes a list of records, the same as:
+        >>> [compiled.normalize(record) for record in records]
+
+        but column by column: the records are rebuilt first, collecting the
+        values of every converted path into a column, and then each column
+        is converted in one loop, from the deepest paths up.
+        '''
+        columns = defaultdict(list)
+
+        results = [
+            build(self.root, record, columns) if isinstance(record, (dict, list)) else remap(self.root, record)
+            for record in records
+        ]
+
+        for node in sorted(columns, key=lambda node: node.depth, reverse=True):
+            function = node.rule.function
+            for container, key, value in columns[node]:
+                if container is None:
+                    # Overwritten by a later value with the same key.
+                    continue
+                try:
+                    container[key] = function(value)
+                except Exception as e:
+                    if callbacks:
+                        emit('rule.errors', 1, {'rule': node.rule.source})
+                    if not isinstance(value, (list, tuple, dict)):
+                        print('Failed to convert value: {}'.format(value))
+                        print(e)
+
+        if isinstance(self.schema, dict):
+            star = self.schema.get('*')
+            for remapped in results:
+                if isinstance(remapped, dict) and star in remapped:
+                    remapped['*'] = remapped.pop(star)
+                    remapped['*'] = star
+
+        return results
+
+    def __repr__(self):
+        return 'CompiledSchema({} paths)'.format(len(self.table))
+
+
+def remap(node, value):
+    '''
+    Rebuilds value, applying the rules of the nodes that match its keys,
+    the same way boltons.iterutils.remap() visits it in normalize().
+    '''
+    if isinstance(value, (str, bytes)):
+        return value
+
+    children = node.children if node is not None else {}
+
+    if type(value) is dict:
+        new = {}
+        for key, item in value.items():
+            child = children.get(0 if isinstance(key, int) else key)
+            item = remap(child, item)
+            if child is not None and child.rule is not None:
+                key, item = child.rule(key, item)
+            new[key] = item
+        return new
+
+    if type(value) is list:
+        new = []
+        child = children.get(0)
+        for key, item in enumerate(value):
+            item = remap(child, item)
+            if child is not None and child.rule is not None:
+                key, item = child.rule(key, item)
+            new.append(item)
+        return new
+
+    if isinstance(value, Mapping):
+        items = value.items()
+    elif isinstance(value, (Sequence, Set)):
+        items = enumerate(value)
+    else:
+        return value
+
+    from boltons.iterutils import default_exit
+
+    new_items = []
+    for key, item in items:
+        child = children.get(0 if isinstance(key, int) else key)
+        item = remap(child, item)
+        if child is not None and child.rule is not None:
+            key, item = child.rule(key, item)
+        new_items.append((key, item))
+
+    return default_exit(None, None, value, value.__class__(), new_items)
+
+
+def step(child, key, value, formatter):
+    '''
+    Normalizes an item by the node of its key (child), formatting the
+    mappings inside its value.
+    '''
+    rule = child.rule if child is not None else None
+
+    if rule is not None and rule.function is not None:
+        # The rule gets the value as normalize() gives it, and its result
+        # is formatted, as formatize() would.
+        key, value = rule(key, remap(child, value))
+        return key, transform(None, value, formatter)
+
+    value = transform(child, value, formatter)
+
+    if rule is not None:
+        key, value = rule(key, value)
+
+    return key, value
+
+
+def transform(node, value, formatter, star=None):
+    '''
+    Rebuilds value like remap(), also applying formatter to the keys and
+    values of its mappings, in the same traversal. If star is given (at the
+    root), the key it was normalized to is moved back to '*', as normalize()
+    does.
+    '''
+    if isinstance(value, (str, bytes)):
+        return value
+
+    children = node.children if node is not None else {}
+
+    if type(value) is list:
+        new = []
+        child = children.get(0)
+        for key, item in enumerate(value):
+            key, item = step(child, key, item, formatter)
+            new.append(item)
+        return new
+
+    if isinstance(value, Mapping):
+        items = [
+            step(children.get(0 if isinstance(key, int) else key), key, item, formatter)
+            for key, item in value.items()
+        ]
+
+        if star is not None or (node is not None and node.renames):
+            # Renamed keys might collide, so resolve them first, as normalize() would.
+            normal = dict(items)
+            if star is not None and star in normal:
+                normal['*'] = normal.pop(star)
+                normal['*'] = star
+            items = normal.items()
+
+        if type(value) is dict:
+            new = {}
+            for key, item in items:
+                key, item = formatter(key, item)
+                new[key] = item
+            return new
+
+        new_items = [formatter(key, item) for key, item in items]
+
+    elif isinstance(value, (Sequence, Set)):
+        child = children.get(0)
+        new_items = [step(child, key, item, formatter) for key, item in enumerate(value)]
+
+    else:
+        return value
+
+    from boltons.iterutils import default_exit
+
+    return default_exit(None, None, value, value.__class__(), new_items)
+
+
+# Key of View.index, that stands for the '*' of the schema.
+STAR = object()
+
+
+class View(Mapping):
+    '''
+    Read-only mapping over a record (data) by the schema node, that is
+    equal to the record format() gives, but resolves the keys of a level
+    when they are first needed, and converts a value when its key is first
+    accessed (keeping the result). Dict values are views as well, unless a
+    rule converts them whole, so only the accessed paths are converted:
+
+    >>> view = compile(schema).view(document)
+    >>> view['title'], view['author']['name']
+    '''
+
+    def __init__(self, node, data, formatter, star=None):
+        self.node = node
+        self.data = data
+        self.formatter = formatter
+        self.star = star
+        self._index = None
+        self._values = {}
+
+    @property
+    def index(self):
+        '''
+        {key: (normalized key, key of data)} in the order of format(), with
+        the later of the keys renamed to the same one.
+        '''
+        if self._index is None:
+            children = self.node.children if self.node is not None else {}
+
+            normal = {}
+            for key in self.data:
+                child = children.get(0 if isinstance(key, int) else key)
+                term = child.rule.term if child is not None and child.rule is not None else None
+                normal[term or key] = key
+
+            if self.star is not None and self.star in normal:
+                normal.pop(self.star)
+                normal['*'] = STAR
+
+            self._index = {self.formatter.key(name): (name, key) for name, key in normal.items()}
+
+        return self._index
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        name, source = self.index[key]
+
+        if source is STAR:
+            value = self.star
+        else:
+            value = self.data[source]
+            child = (self.node.children if self.node is not None else {}).get(
+                0 if isinstance(source, int) else source)
+            rule = child.rule if child is not None else None
+
+            if isinstance(value, Mapping) and (rule is None or rule.function is None):
+                value = View(child, value, self.formatter)
+            else:
+                name, value = step(child, source, value, self.formatter)
+
+        value = self._values[key] = self.formatter(name, value)[1]
+
+        return value
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def project(self, fields):
+        '''
+        Returns the dict of fields of the view: paths of keys (e.g.,
+        ['owner', 'id'], or 'id' for ['id']), that are normalized, or
+        source keys (at any level), and lists on the way are projected
+        item by item. Only the values on the paths are converted. A key is
+        a source key only if no normalized key of its level is the same.
+
+        >>> compile({'owner': {'id': {'*': 'user-id#integer'}}}).view(topic).project([['owner', 'user-id']])
+        {'owner': {'user-id': 1}}
+        '''
+        tree = fields if isinstance(fields, dict) else field_tree(fields)
+
+        # The keys of the view by the fields they are given by, either by
+        # any of their normalized keys (also, without '#format'), or by
+        # their source key.
+        outputs = defaultdict(list)
+        sources = defaultdict(list)
+        for key, (name, source) in self.index.items():
+            names = {key, name}
+            if isinstance(name, str) and '#' in name[1:-1]:
+                names.add(name.rsplit('#', 1)[0])
+
+            for candidate in names:
+                if candidate in tree:
+                    outputs[candidate].append(key)
+            if source in tree and source not in names:
+                sources[source].append(key)
+
+        found = defaultdict(list)
+        for field, subtree in tree.items():
+            for key in outputs.get(field) or sources.get(field, []):
+                found[key].append(subtree)
+
+        return {key: self._project(key, merge_trees(found[key])) for key in self.index if key in found}
+
+    def _project(self, key, tree):
+        name, source = self.index[key]
+
+        if tree is None or source is STAR:
+            return materialize(self[key])
+
+        value = self.data[source]
+        child = (self.node.children if self.node is not None else {}).get(0 if isinstance(source, int) else source)
+        rule = child.rule if child is not None else None
+
+        if type(value) is not list or (rule is not None and rule.function is not None):
+            value = self[key]
+            return value.project(tree) if isinstance(value, View) else select(value, tree)
+
+        # Items of the list projected one by one (see transform).
+        item_child = child.children.get(0) if child is not None else None
+        item_rule = item_child.rule if item_child is not None else None
+        items = []
+
+        for i, item in enumerate(value):
+            if isinstance(item, Mapping) and (item_rule is None or item_rule.function is None):
+                items.append(View(item_child, item, self.formatter).project(tree))
+            else:
+                items.append(select(step(item_child, i, item, self.formatter)[1], tree))
+
+        return self.formatter(name, items)[1]
+
+    def __repr__(self):
+        return 'View({} keys, {} accessed)'.format(len(self), len(self._values))
+
+
+def field_tree(fields):
+    '''
+    Returns {key: {key: ... None}} of field paths, where None stands for
+    the whole value (also, if a path is within another one).
+    >>> field_tree([['a', 'b'], 'c', ['a', 'd']])
+    {'a': {'b': None, 'd': None}, 'c': None}
+    '''
+    tree = {}
+
+    for path in fields:
+        path = [path] if isinstance(path, (str, int)) else list(path)
+        level = tree
+        for i, key in enumerate(path):
+            if i == len(path) - 1:
+                level[key] = None
+                break
+            if key in level and level[key] is None:
+                break
+            level = level.setdefault(key, {})
+
+    return tree
+
+
+def merge_trees(trees):
+    '''
+    Returns the field tree of the fields of all of trees.
+    '''
+    if any(tree is None for tree in trees):
+        return None
+
+    merged = {}
+    for tree in trees:
+        for key, subtree in tree.items():
+            merged[key] = merge_trees([merged[key], subtree]) if key in merged else subtree
+
+    return merged
+
+
+def select(value, tree):
+    '''
+    Returns the fields of tree of a (converted) value.
+    '''
+    if tree is None:
+        return materialize(value)
+
+    if isinstance(value, Mapping):
+        return {key: select(item, tree[key]) for key, item in value.items() if key in tree}
+
+    if type(value) is list:
+        return [select(item, tree) for item in value]
+
+    return materialize(value)
+
+
+def materialize(value):
+    '''
+    Returns value with the views in it replaced by dicts.
+    '''
+    if isinstance(value, View):
+        return {key: materialize(item) for key, item in value.items()}
+
+    if type(value) is list:
+        return [materialize(item) for item in value]
+
+    return value
+
+
+ATOMS = {str, int, float, bool, type(None)}
+
+
+def build(node, value, columns):
+    '''
+    Rebuilds a dict or list value like remap(), but instead of converting
+    values, appends [container, key, value] slots to the columns of nodes.
+    '''
+    children = node.children if node is not None else {}
+
+    if isinstance(value, dict):
+        new = {} if type(value) is dict else value.__class__()
+        # The pending slots of new, by key.
+        slots = {}
+        for key, item in value.items():
+            child = children.get(0 if isinstance(key, int) else key)
+
+            if isinstance(item, (dict, list)):
+                item = build(child, item, columns)
+            elif type(item) not in ATOMS:
+                item = remap(child, item)
+
+            slot = None
+            if child is not None and child.rule is not None:
+                if child.rule.term:
+                    key = child.rule.term
+                if child.rule.function is not None:
+                    slot = [new, key, item]
+
+            if key in slots:
+                # A later key renamed to the same key: its value is kept, as
+                # dict.update() keeps the last one.
+                slots.pop(key)[0] = None
+            if slot is not None:
+                columns[child].append(slot)
+                slots[key] = slot
+            new[key] = item
+
+        return new
+
+    new = [] if type(value) is list else value.__class__()
+    child = children.get(0)
+    function = child is not None and child.rule is not None and child.rule.function is not None
+    for item in value:
+
+        if isinstance(item, (dict, list)):
+            item = build(child, item, columns)
+        elif type(item) not in ATOMS:
+            item = remap(child, item)
+
+        if function:
+            columns[child].append([new, len(new), item])
+        new.append(item)
+
+    return new
+
+
+def get_compiled(schema):
+    '''
+    Returns the CompiledSchema of schema (with the default options),
+    compiling it once per content of schema, so a schema changed in place
+    is compiled again. The content is its repr, rather than JSON, so that
+    the order of the keys (that records are normalized in) counts, and 1
+    is not '1'.
+    '''
+    if isinstance(schema, CompiledSchema):
+        return schema
+
+    key = repr(schema)
+    compiled = compiled_memo.get(key)
+
+    if compiled is None:
+        compiled = compile(schema)
+        compiled_memo.set(key, compiled)
+
+    return compiled
+
+
+def compile(schema, slugify=False, namespace=False, storage=None):
+    '''
+    Compiles schema into a CompiledSchema, that can normalize many records.
+
+    >>> compiled = compile(schema, namespace=True)
+    >>> [compiled.normalize(record) for record in records]
+    '''
+    if isinstance(schema, CompiledSchema):
+        return schema
+    return CompiledSchema(schema, slugify=slugify, namespace=namespace, storage=storage)
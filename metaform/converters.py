@@ -1,11 +1,52 @@
+import builtins
 import decimal as deci
 from datetime import datetime
 
-from dateutil.parser import parse as dateparse
+
+def dateparse(x):
+    from dateutil.parser import parse
+    return parse(x)
+
+
+def _batched(base):
+    '''
+    Adds .many(values, silent=True) to a converter, that converts values
+    into a list: all at once by base (e.g., int), if they all convert, or
+    else value by value by the converter, e.g.:
+    >>> integer.many(['1', '2', 'x'])
+    [1, 2, 'x']
+    '''
+    def decorate(function):
+
+        def many(values, silent=True):
+            values = values if isinstance(values, (list, tuple)) else list(values)
+            try:
+                return list(map(base, values))
+            except Exception:
+                return [function(value, silent) for value in values]
+
+        function.many = many
+        return function
+
+    return decorate
+
+
+def _fromisoformat(x):
+    '''
+    Parses ISO-8601 strings with datetime.fromisoformat, and the others (or
+    partial dates, like '2020') with dateutil.
+    '''
+    if isinstance(x, str):
+        try:
+            return datetime.fromisoformat(x)
+        except ValueError:
+            pass
+    return dateparse(x)
 
 # TODO: refactor exceptions
 
 
+@_batched(dict)
 def object(x, silent=True):
     # return dict(x)
     try:
@@ -17,6 +58,7 @@ def object(x, silent=True):
             raise e
 
 
+@_batched(int)
 def integer(x, silent=True):
     # return int(x)
     try:
@@ -28,6 +70,7 @@ def integer(x, silent=True):
             raise e
 
 
+@_batched(deci.Decimal)
 def decimal(x, silent=True):
     # return float(x)
     try:
@@ -39,10 +82,11 @@ def decimal(x, silent=True):
             raise e
 
 
+@_batched(builtins.float)
 def rational(x, silent=True):
     # return float(x)
     try:
-        return float(x)
+        return builtins.float(x)
     except Exception as e:
         if silent:
             return x
@@ -50,10 +94,11 @@ def rational(x, silent=True):
             raise e
 
 
+@_batched(builtins.float)
 def float(x, silent=True):
     # return float(x)
     try:
-        return float(x)
+        return builtins.float(x)
     except Exception as e:
         if silent:
             return x
@@ -61,6 +106,7 @@ def float(x, silent=True):
             raise e
 
 
+@_batched(str)
 def string(x, silent=True):
     # return str(x)
     try:
@@ -72,10 +118,11 @@ def string(x, silent=True):
             raise e
 
 
+@_batched(_fromisoformat)
 def isodate(x, silent=True):
     # return isoparse(x)
     try:
-        return dateparse(x)
+        return _fromisoformat(x)
     except Exception as e:
         if silent:
             return x
@@ -83,6 +130,7 @@ def isodate(x, silent=True):
             raise e
 
 
+@_batched(datetime.utcfromtimestamp)
 def unixtime(x, silent=True):
     # return isoparse(x)
     try:
@@ -107,3 +155,49 @@ def unixtime(x, silent=True):
 
 def imarkdown(x):
     return x
+
+
+def vectorized(function, series):
+    '''
+    Applies a converter to a pandas Series: the known ones (integer, float,
+    rational, string, unixtime, isodate) as whole-column operations, when
+    the column allows, and any other function (or column) value by value.
+
+    >>> vectorized(integer, pandas.Series(['1', '2']))
+    '''
+    import pandas as pd
+    from pandas.api import types
+
+    try:
+        if function is integer:
+            if types.is_integer_dtype(series):
+                return series
+            if types.is_float_dtype(series):
+                # (raises on NaN, which int() leaves as it is)
+                return series.astype('int64')
+            if types.is_object_dtype(series) or types.is_string_dtype(series):
+                if series.str.fullmatch(r'\s*[-+]?\d+\s*').eq(True).all():
+                    return series.astype('int64')
+
+        elif function is float or function is rational:
+            if types.is_numeric_dtype(series) and not types.is_bool_dtype(series):
+                return series.astype('float64')
+
+        elif function is string:
+            if types.is_numeric_dtype(series) and not types.is_bool_dtype(series):
+                return series.astype(str).astype(object)
+
+        elif function is unixtime:
+            if types.is_numeric_dtype(series) and not types.is_bool_dtype(series) and series.notna().all():
+                return pd.to_datetime(series, unit='s').dt.round('us').astype('datetime64[us]')
+
+        elif function is isodate:
+            if types.is_object_dtype(series) or types.is_string_dtype(series):
+                # (dateutil fills partial dates from today, so only full dates)
+                if series.str.match(r'\d{4}-\d{2}-\d{2}').eq(True).all():
+                    return pd.to_datetime(series, format='ISO8601')
+
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        pass
+
+    return series.apply(function)
@@ -0,0 +1,168 @@
+'''
+Inference of templates (see metaform.template) from streams of records.
+
+Records are merged one by one into a Shape: the keys found at every path
+(of all the records, not only the first, or the last), the types of the
+values, and the converters, that all of the values parse by. So, memory
+depends on the number of paths, rather than of records:
+
+>>> infer(iterload('logs.ndjson'))
+{'id': {'*': '|to.integer'}, 'tags': [{'*': ''}], 'at': {'*': '|to.isodate'}, '*': ''}
+
+With sample=N, the shape is inferred from N records, sampled uniformly
+from the whole stream (reservoir sampling), e.g., to be quicker:
+>>> infer(iterload('logs.ndjson'), sample=10000, seed=0)
+'''
+import random
+from collections import Counter
+from datetime import datetime
+
+# (converter, parse): converters suggested for the values of a path, in the
+# order of preference, if all of them parse (and some are strings).
+CONVERTERS = [
+    ('integer', int),
+    ('float', float),
+    ('isodate', datetime.fromisoformat),
+]
+
+# {type: converters, that values of the type need no parsing for}
+NATIVE = {int: {'integer', 'float'}, float: {'float'}}
+
+
+class Shape:
+    '''
+    Merged shape of the values at a path: how many were seen, of what
+    types, the shapes of the keys of dicts, and of the items of lists.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.types = Counter()
+        self.keys = {}
+        self.items = None
+        # Converters, that some of the values seen do not parse by.
+        self.invalid = set()
+
+    def add(self, value):
+        self.count += 1
+        self.types[type(value).__name__] += 1
+
+        if isinstance(value, dict):
+            for key, item in value.items():
+                shape = self.keys.get(key)
+                if shape is None:
+                    shape = self.keys[key] = Shape()
+                shape.add(item)
+
+        elif isinstance(value, (list, tuple)):
+            if self.items is None:
+                self.items = Shape()
+            for item in value:
+                self.items.add(item)
+
+        elif value is not None:
+            self.check(value)
+
+        return self
+
+    def update(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def check(self, value):
+        for name, parse in CONVERTERS:
+            if name in self.invalid:
+                continue
+            if isinstance(value, str):
+                try:
+                    parse(value)
+                except (ValueError, OverflowError):
+                    self.invalid.add(name)
+            elif name not in NATIVE.get(type(value), ()):
+                self.invalid.add(name)
+
+    @property
+    def converter(self):
+        '''
+        Name of the converter suggested for the values, if any.
+        '''
+        if not self.types['str'] or self.keys or self.items is not None:
+            return
+        for name, parse in CONVERTERS:
+            if name not in self.invalid:
+                return name
+
+    def template(self, with_self=True, suggest=True):
+        '''
+        Returns the template of the shape, where the rules are the
+        suggested converters (e.g., '|to.integer'), if suggest.
+        '''
+        rule = '|to.{}'.format(self.converter) if suggest and self.converter else ''
+
+        if self.keys and self.types['dict'] >= self.types['list'] + self.types['tuple']:
+            template = {key: shape.template(with_self=False, suggest=suggest) for key, shape in self.keys.items()}
+            if with_self:
+                template['*'] = rule
+            return template
+
+        if self.items is not None:
+            return [self.items.template(suggest=suggest)]
+
+        return {'*': rule}
+
+    def stats(self, path=()):
+        '''
+        Returns {path: {'count': n, 'types': {type: n}, 'converter': name}}
+        of the shape and the ones below it (the items of lists at 0).
+        '''
+        stats = {path: {'count': self.count, 'types': dict(self.types), 'converter': self.converter}}
+
+        for key, shape in self.keys.items():
+            stats.update(shape.stats(path + (key,)))
+        if self.items is not None:
+            stats.update(self.items.stats(path + (0,)))
+
+        return stats
+
+
+def reservoir(records, size, seed=None):
+    '''
+    Returns size records sampled uniformly from records (all of them, if
+    fewer), reading them once.
+    '''
+    rng = random.Random(seed)
+    sample = []
+
+    for i, record in enumerate(records):
+        if i < size:
+            sample.append(record)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                sample[j] = record
+
+    return sample
+
+
+def infer_shape(records, sample=None, seed=None):
+    '''
+    Returns the Shape of records (or of a sample of them).
+    '''
+    if sample is not None:
+        records = reservoir(records, sample, seed=seed)
+
+    return Shape().update(records)
+
+
+def infer(records, sample=None, seed=None, with_self=True, suggest=True):
+    '''
+    Returns the template of records (an iterable of them, e.g., iterload()),
+    from all of them, or from a uniform sample of sample records. The rules
+    of the template are the converters (see metaform.converters), that
+    all the values found at the path parse by, if suggest.
+
+    >>> infer([{'a': '1', 'b': [{'c': 1.5}]}, {'a': '2', 'b': [{'d': '2020-01-01'}]}])
+    {'a': {'*': '|to.integer'}, 'b': [{'c': {'*': ''}, 'd': {'*': '|to.isodate'}, '*': ''}], '*': ''}
+    '''
+    return infer_shape(records, sample=sample, seed=seed).template(with_self=with_self, suggest=suggest)
@@ -0,0 +1,83 @@
+'''
+Normalization of records across a process pool.
+
+Records are sent to the workers in chunks, and the schema source (not the
+compiled one, as the callables evaluated from rules do not pickle) is sent
+once per worker, which compiles it on its side:
+
+>>> normalize_many(records, schema, workers=32, chunksize=1000)
+'''
+from itertools import islice
+
+from metaform.compiled import CompiledSchema, compile
+
+# {key: CompiledSchema} of a worker
+compiled_schemas = {}
+
+
+def initialize(schema, options):
+    compiled_schemas[None] = compile(schema, **options)
+
+
+def normalize_chunk(records, schema=None, options=None, key=None):
+    compiled = compiled_schemas.get(key)
+
+    if compiled is None:
+        compiled = compiled_schemas[key] = compile(schema, **options)
+
+    return compiled.normalize_many(records)
+
+
+def chunked(records, chunksize):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def normalize_parallel(records, schema, options, executor=None, workers=None, chunksize=1000, ordered=True):
+    '''
+    Normalizes records by schema on an executor (or a new process pool of
+    workers), chunksize records per task. Returns the normalized records
+    in the order of records, or (ordered=False) of the chunks finishing.
+
+    Falls back to normalizing in this process, if the schema or options
+    (e.g., storage) can not be pickled.
+    '''
+    import hashlib
+    import pickle
+
+    if isinstance(schema, CompiledSchema):
+        schema, options = schema.schema, schema.options
+
+    try:
+        payload = pickle.dumps((schema, options))
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print('Schema can not be sent to workers ({}), normalizing in this process.'.format(e))
+        return compile(schema, **options).normalize_many(records)
+
+    if executor is None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=initialize, initargs=(schema, options)) as pool:
+            return collect([pool.submit(normalize_chunk, chunk) for chunk in chunked(records, chunksize)], ordered)
+
+    key = hashlib.sha1(payload).hexdigest()
+
+    return collect([
+        executor.submit(normalize_chunk, chunk, schema, options, key)
+        for chunk in chunked(records, chunksize)
+    ], ordered)
+
+
+def collect(futures, ordered=True):
+    from concurrent.futures import as_completed
+
+    results = []
+
+    for future in (futures if ordered else as_completed(futures)):
+        results.extend(future.result())
+
+    return results
@@ -0,0 +1,162 @@
+'''
+Opt-in instrumentation: timings of the stages (normalize, formatize,
+translate, format) and counters of what they did, sent to callbacks as
+callback(metric, value, tags), e.g.:
+
+>>> with instrument() as stats:
+...     List(records).format(schema)
+>>> stats
+{'format.calls': 1, 'format.seconds': 0.0421, 'format.nodes': 5300, 'schema.hits': 1, 'rule.evals': 3, ...}
+
+Or, for the lifetime of the process (e.g., to send to a metrics pipeline):
+>>> subscribe(lambda metric, value, tags: statsd.increment(metric, value, tags=tags))
+
+Metrics:
+    - <stage>.calls, <stage>.seconds, <stage>.nodes (values and containers of the input),
+    - schema.hits, schema.misses, schema.fetches, schema.fetch_seconds, schema.fetch_errors,
+    - concept.hits, concept.misses, concept.fetches, concept.fetch_seconds, concept.fetch_errors,
+    - rule.evals, rule.eval_seconds, rule.eval_errors (rule sources evaluated into callables),
+    - rule.errors (rules failing on a value), converter.errors (formats failing on a value).
+
+Tags are a dict of the schema (its '*'), rule source, or key, if any.
+
+Without callbacks, the stages only check that the list of callbacks is
+empty, so there is nothing to pay for, unless instrumented.
+'''
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+# Callbacks, that get the metrics. Changed in place only, so that modules
+# importing it see the changes.
+callbacks = []
+
+_callbacks_lock = threading.Lock()
+
+
+class Stats(dict):
+    '''
+    {metric: sum of values} of the metrics it was called with.
+    '''
+
+    def __call__(self, metric, value=1, tags=None):
+        self[metric] = self.get(metric, 0) + value
+
+
+def subscribe(callback):
+    with _callbacks_lock:
+        callbacks.append(callback)
+
+
+def unsubscribe(callback):
+    with _callbacks_lock:
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+
+@contextmanager
+def instrument(callback=None):
+    '''
+    Sends the metrics to callback (or to the Stats it returns, if none)
+    within the block.
+    '''
+    if callback is None:
+        callback = Stats()
+
+    subscribe(callback)
+    try:
+        yield callback
+    finally:
+        unsubscribe(callback)
+
+
+def emit(metric, value=1, tags=None):
+    for callback in list(callbacks):
+        try:
+            callback(metric, value, tags or {})
+        except Exception as e:
+            print('Instrumentation callback failed: {}'.format(e))
+
+
+def count_nodes(data):
+    '''
+    Returns the number of values and containers in data.
+    '''
+    count = 0
+    stack = [data]
+
+    while stack:
+        value = stack.pop()
+        count += 1
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+
+    return count
+
+
+def schema_name(schema, data):
+    if isinstance(schema, list) and schema:
+        schema = schema[0]
+    if isinstance(schema, dict) and schema.get('*'):
+        return schema['*']
+    if hasattr(schema, 'schema'):
+        return schema_name(schema.schema, None)
+    if isinstance(data, dict) and data.get('*'):
+        return data['*']
+
+
+def stage(name, schema=False):
+    '''
+    Decorates a stage function of (data, schema, ...), or of (data, ...)
+    without schema, to emit its metrics, if instrumented.
+    '''
+    def decorate(function):
+
+        @wraps(function)
+        def instrumented(*args, **kwargs):
+            if not callbacks:
+                return function(*args, **kwargs)
+
+            started = perf_counter()
+            result = function(*args, **kwargs)
+            seconds = perf_counter() - started
+
+            data = args[0] if args else kwargs.get('data')
+            tags = {}
+            if schema:
+                tags['schema'] = schema_name(args[1] if len(args) > 1 else kwargs.get('schema'), data)
+
+            emit(name + '.calls', 1, tags)
+            emit(name + '.seconds', seconds, tags)
+            emit(name + '.nodes', count_nodes(data), tags)
+
+            return result
+
+        return instrumented
+
+    return decorate
+
+
+@contextmanager
+def fetch(kind, url):
+    '''
+    Emits the kind.fetches, kind.fetch_seconds (and kind.fetch_errors) of
+    the block fetching url, if instrumented.
+    '''
+    if not callbacks:
+        yield
+        return
+
+    started = perf_counter()
+    tags = {kind: url}
+    try:
+        yield
+    except BaseException:
+        emit(kind + '.fetch_errors', 1, tags)
+        raise
+    finally:
+        emit(kind + '.fetches', 1, tags)
+        emit(kind + '.fetch_seconds', perf_counter() - started, tags)
@@ -0,0 +1,110 @@
+'''
+Compact records: read-only mappings, that keep their values in a tuple,
+and share the tuple of their keys (a Layout) with all the records of the
+same keys, rather than each having a dict of its own:
+
+>>> rows = compact([{'https://www.wikidata.org/wiki/Q82799': 'Max', 'age': 21}, ...])
+>>> rows[0]['age']
+21
+>>> rows[0].layout is rows[1].layout
+True
+
+Records with the same keys in the same order share a layout (e.g., all
+records formatted by a schema, mostly), and the keys of layouts are
+interned, so each key string is kept once.
+'''
+import sys
+from collections.abc import Mapping
+
+
+class Layout:
+    '''
+    Keys of rows, and {key: position of its value}.
+    '''
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = tuple(sys.intern(key) if type(key) is str else key for key in keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+
+    def __repr__(self):
+        return 'Layout({!r})'.format(self.keys)
+
+
+class Row(Mapping):
+    '''
+    Read-only mapping of the keys of layout to values (a tuple).
+    '''
+    __slots__ = ('layout', '_values')
+
+    def __init__(self, layout, values):
+        self.layout = layout
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self.layout.index[key]]
+
+    def get(self, key, default=None):
+        i = self.layout.index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self.layout.index
+
+    def __iter__(self):
+        return iter(self.layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def to_dict(self):
+        '''
+        Returns the row as a dict (and the rows in it, as well).
+        '''
+        return {key: expand(value) for key, value in zip(self.layout.keys, self._values)}
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self.items()))
+
+
+def expand(value):
+    '''
+    Returns value with the rows in it replaced by dicts.
+    '''
+    if isinstance(value, Row):
+        return value.to_dict()
+    if type(value) is list:
+        return [expand(item) for item in value]
+    return value
+
+
+class Layouts(dict):
+    '''
+    {keys: Layout} shared by the rows compacted with it.
+    '''
+
+    def row(self, record):
+        keys = tuple(record)
+        layout = self.get(keys)
+
+        if layout is None:
+            layout = self[keys] = Layout(keys)
+
+        return Row(layout, tuple(self.compact(value) for value in record.values()))
+
+    def compact(self, value):
+        if type(value) is dict:
+            return self.row(value)
+        if type(value) is list:
+            return [self.compact(item) for item in value]
+        return value
+
+
+def compact(records, layouts=None):
+    '''
+    Returns the list of records (dicts, or lists of them, at any depth)
+    as rows, sharing the layouts (a Layouts) of the same keys.
+    '''
+    layouts = Layouts() if layouts is None else layouts
+
+    return [layouts.compact(record) for record in records]
@@ -0,0 +1,155 @@
+'''
+Normalization of streams of records of mixed schemas (their '*'), e.g.,
+feeds interleaving records of several sources:
+
+>>> router = Router()
+>>> router.normalize(records)
+>>> router.throughput()
+{'GH:wefindx/schema/Topic': 52110.3, 'GH:wefindx/schema/Comment': 48774.9}
+
+Records are grouped by their '*', the schema of each group is resolved
+and compiled once (for all the calls of the router), each group is
+normalized in batch (see CompiledSchema.normalize_many), and the records
+are returned in their original order.
+'''
+from time import perf_counter
+
+from metaform.compiled import Formatter, compile
+from metaform.parallel import normalize_parallel
+from metaform.profiling import callbacks, emit
+from metaform.utils import get_schema
+
+
+def schema_key(record):
+    '''
+    Returns the '*' of record, or None, if it has none (or it is not one).
+    '''
+    try:
+        key = record.get('*')
+        hash(key)
+    except (AttributeError, TypeError):
+        return None
+
+    return key
+
+
+class Router:
+    '''
+    Routes records to the schemas of their '*' (or to schema, for records
+    without '*'), keeping {'*': {'records': n, 'seconds': s}} in stats.
+
+    refresh: fetch each schema again, once per router (rather than once
+    per record, as normalize(record, refresh=True) does).
+    '''
+
+    def __init__(self, schema=None, slugify=False, namespace=False, storage=None, refresh=False,
+                 executor=None, workers=None, chunksize=1000):
+        self.schema = schema
+        self.options = {'slugify': slugify, 'namespace': namespace, 'storage': storage}
+        self.refresh = refresh
+        self.parallel = {'executor': executor, 'workers': workers, 'chunksize': chunksize}
+        self.schemas = {}
+        self.compiled = {}
+        self.stats = {}
+
+    def resolve(self, key):
+        '''
+        Returns the schema of key (a '*'), resolved once.
+        '''
+        if key not in self.schemas:
+            if key is None:
+                self.schemas[key] = self.schema
+            else:
+                self.schemas[key] = get_schema(key, refresh=self.refresh)
+
+        return self.schemas[key]
+
+    def get_compiled(self, key):
+        if key not in self.compiled:
+            self.compiled[key] = compile(self.resolve(key), **self.options)
+
+        return self.compiled[key]
+
+    def groups(self, records):
+        '''
+        Returns {'*': [positions of its records]}, in the order of the first
+        record of each.
+        '''
+        groups = {}
+
+        for i, record in enumerate(records):
+            groups.setdefault(schema_key(record), []).append(i)
+
+        return groups
+
+    def route(self, records, process):
+        '''
+        Returns process(key, schema, group) of the groups of records, in
+        the order of records.
+        '''
+        records = records if isinstance(records, list) else list(records)
+        results = [None] * len(records)
+
+        for key, positions in self.groups(records).items():
+            started = perf_counter()
+
+            group = process(key, self.resolve(key), [records[i] for i in positions])
+            for i, result in zip(positions, group):
+                results[i] = result
+
+            self.count(key, len(positions), perf_counter() - started)
+
+        return results
+
+    def count(self, key, records, seconds):
+        stats = self.stats.setdefault(key, {'records': 0, 'seconds': 0.0})
+        stats['records'] += records
+        stats['seconds'] += seconds
+
+        if callbacks:
+            tags = {'schema': key}
+            emit('route.records', records, tags)
+            emit('route.seconds', seconds, tags)
+
+    def throughput(self):
+        '''
+        Returns {'*': records per second} of the records routed so far.
+        '''
+        return {key: stats['records'] / stats['seconds'] if stats['seconds'] else None
+                for key, stats in self.stats.items()}
+
+    def normalize(self, records):
+        '''
+        Returns the same as [normalize(record, ...) for record in records].
+        '''
+        def process(key, schema, group):
+            if not schema:
+                # As normalize() does, if the schema is not found.
+                from metaform import normalize
+                return [normalize(record, schema=self.schema, refresh=self.refresh, **self.options) for record in group]
+
+            if self.parallel['workers'] or self.parallel['executor']:
+                return normalize_parallel(group, self.get_compiled(key), self.options, **self.parallel)
+
+            return self.get_compiled(key).normalize_many(group)
+
+        return self.route(records, process)
+
+    def format(self, records, formatter=None, lang=None):
+        '''
+        Returns the same as [formatted(record, lang=lang) for record in
+        records], the formatter (see Formatter) shared by all of them.
+        '''
+        if formatter is None:
+            formatter = Formatter(lang=lang, refresh=self.refresh)
+
+        def process(key, schema, group):
+            if not schema:
+                # As normalize() does, if the schema is not found.
+                from metaform import formatted
+                return [formatted(record, schema=self.schema, formatter=formatter) for record in group]
+
+            compiled = self.get_compiled(key)
+            return [compiled.format(record, formatter=formatter) for record in group]
+
+        return self.route(records, process)
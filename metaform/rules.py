@@ -0,0 +1,133 @@
+'''
+Rules are the part of the schema after '|', e.g.:
+
+    'https://www.wikidata.org/wiki/Q82799|lambda _: _.title()'
+
+Rules are Python expressions, evaluated with eval() and all the builtins,
+so they are not sandboxed: normalize by the schemas of sources you trust.
+
+The cache keeps the callables evaluated from rule sources, so that the same
+source is evaluated once, rather than once for every value. Rules, that
+fail to evaluate are cached too, and reported once.
+
+>>> cache.get('lambda _: _.title()')('max')
+'Max'
+>>> cache.info()
+RuleCacheInfo(hits=0, misses=1, errors=0, maxsize=1024, currsize=1)
+'''
+import threading
+from collections import OrderedDict, namedtuple
+from time import perf_counter
+
+from metaform.profiling import callbacks, emit
+
+RuleCacheInfo = namedtuple('RuleCacheInfo', ['hits', 'misses', 'errors', 'maxsize', 'currsize'])
+
+
+class RuleError(Exception):
+    '''
+    Raised for rules, that could not be evaluated into a callable.
+    '''
+
+    def __init__(self, source, error):
+        super().__init__('Failed to evaluate rule: {} ({})'.format(source, error))
+        self.source = source
+        self.error = error
+
+
+def evaluate(source):
+    '''
+    Evaluates rule source in a copy of the metaform package namespace
+    (so, 'to.integer', 'converters.func', and builtins resolve as before),
+    so that a rule does not rebind names of the package by mistake. It is
+    not a sandbox: the rule can still import, or change, anything.
+    The lazily imported names (metaform.LAZY) are imported, if used.
+    '''
+    import metaform
+
+    namespace = dict(vars(metaform))
+    for name in metaform.LAZY:
+        if name in source:
+            namespace[name] = getattr(metaform, name)
+
+    return eval(source, namespace)
+
+
+class RuleCache:
+    '''
+    Bounded LRU cache of {rule source -> callable}.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rules = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source):
+        '''
+        Returns the callable for the rule source, or raises RuleError.
+        '''
+        with self._lock:
+            try:
+                function = self._rules[source]
+                self._rules.move_to_end(source)
+                self.hits += 1
+            except KeyError:
+                function = None
+
+        if function is None:
+            started = perf_counter()
+            try:
+                function = evaluate(source)
+            except Exception as e:
+                print('Failed to evaluate rule: {}'.format(source))
+                print(e)
+                function = RuleError(source, e)
+
+            if callbacks:
+                tags = {'rule': source}
+                emit('rule.evals', 1, tags)
+                emit('rule.eval_seconds', perf_counter() - started, tags)
+                if isinstance(function, RuleError):
+                    emit('rule.eval_errors', 1, tags)
+
+            with self._lock:
+                self.misses += 1
+                self._rules[source] = function
+                while len(self._rules) > self.maxsize:
+                    self._rules.popitem(last=False)
+
+        if isinstance(function, RuleError):
+            raise function
+
+        return function
+
+    __getitem__ = get
+
+    def info(self):
+        with self._lock:
+            return RuleCacheInfo(
+                self.hits, self.misses,
+                sum(isinstance(function, RuleError) for function in self._rules.values()),
+                self.maxsize, len(self._rules))
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._rules) > self.maxsize:
+                self._rules.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._rules.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+cache = RuleCache()
+
+
+def get_rule(source):
+    return cache.get(source)
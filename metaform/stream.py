@@ -0,0 +1,88 @@
+'''
+Incremental readers, that yield the records of a file one by one, without
+reading it whole:
+
+    - iter_json: JSON array, NDJSON (JSON lines), or concatenated JSON values,
+    - iter_yaml: YAML documents (a document, that is a list, yields its items).
+'''
+import json
+
+CHUNK_SIZE = 65536
+
+decoder = json.JSONDecoder()
+
+
+def iter_json(f, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the records of a JSON array, or of JSON values one after another
+    (e.g., NDJSON), from a text file-like object.
+
+    >>> list(iter_json(io.StringIO('[{"a": 1}, {"a": 2}]')))
+    [{'a': 1}, {'a': 2}]
+    >>> list(iter_json(io.StringIO('{"a": 1}\\n{"a": 2}\\n')))
+    [{'a': 1}, {'a': 2}]
+    '''
+    buffer = ''
+    position = 0
+    eof = False
+    in_array = None
+
+    while True:
+
+        # Skip whitespace (and commas between array items), reading on.
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == ',')):
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+
+        if position >= len(buffer):
+            return
+
+        if in_array is None:
+            in_array = buffer[position] == '['
+            if in_array:
+                position += 1
+            continue
+
+        if in_array and buffer[position] == ']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+
+        # Incomplete, or ending with the buffer, so might continue (e.g., numbers).
+        if end is None or (end == len(buffer) and not eof):
+            chunk = f.read(max(chunk_size, len(buffer)))
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        position = end
+        yield record
+
+
+def iter_yaml(f):
+    '''
+    Yields the records of YAML documents from a file-like object.
+    '''
+    import yaml
+
+    try:
+        loader = yaml.CLoader
+    except AttributeError:
+        loader = yaml.Loader
+
+    for document in yaml.load_all(f, Loader=loader):
+        if isinstance(document, list):
+            for record in document:
+                yield record
+        elif document is not None:
+            yield document
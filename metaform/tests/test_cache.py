@@ -0,0 +1,269 @@
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from metaform import cache, cache_stats, configure, prefetch, translate, utils
+from metaform.cache import (LOCK_BUCKETS, MISSING, CachedStore, Memo, MemoryStore, SqliteStore, Store, get_settings,
+                            lock, open_store, settings)
+from typology.utils import slug
+
+
+def write_keys(path, worker):
+    store = open_store('schemas', 'schema', path=path)
+    for i in range(100):
+        store.set('{}-{}'.format(worker, i), {'*': i})
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.schemas = utils.schemas
+        self.concepts = utils.concepts
+        self.t_get_schema = utils.t_get_schema
+        self.Concept = utils.Concept
+        self.settings = dict(settings)
+
+    def tearDown(self):
+        settings.update(self.settings)
+        utils.schemas = self.schemas
+        utils.concepts = self.concepts
+        utils.t_get_schema = self.t_get_schema
+        utils.Concept = self.Concept
+        shutil.rmtree(self.path)
+
+    def test_sqlite_store(self):
+        store = SqliteStore(os.path.join(self.path, 'cache.sqlite3'), 'schemas')
+        store.set('a', {'*': 'x'})
+        store.set('b', None)
+        store.set('a', {'*': 'y'})
+
+        self.assertEqual(store.get('a'), {'*': 'y'})
+        self.assertIsNone(store.get('b', 'default'))
+        self.assertEqual(store.get('c', 'default'), 'default')
+        self.assertEqual(len(store), 2)
+
+        store.delete('a')
+        self.assertNotIn('a', store)
+
+    def test_cached_store(self):
+        memory = MemoryStore({'a': 1})
+        store = CachedStore(memory)
+
+        self.assertEqual(store.get('a'), 1)
+        memory.delete('a')
+        self.assertEqual(store.get('a'), 1)
+
+    def test_migrate(self):
+        with open(os.path.join(self.path, 'schemas.json'), 'w') as f:
+            json.dump({'_default': {
+                '1': {'slug': 'a', 'schema': {'*': 'first'}},
+                '2': {'slug': 'a', 'schema': {'*': 'second'}},
+                '3': {'slug': 'b', 'schema': None}}}, f)
+
+        store = open_store('schemas', 'schema', path=self.path)
+
+        self.assertEqual(store.get('a'), {'*': 'first'})
+        self.assertIn('b', store)
+        self.assertEqual(len(open_store('schemas', 'schema', path=self.path)), 2)
+
+    def test_readonly_store(self):
+        store = open_store('schemas', 'schema', path=self.path)
+        store.set('a', {'*': 'x'})
+        filename = os.path.join(self.path, 'cache.sqlite3')
+        mtime = os.path.getmtime(filename)
+
+        store = open_store('schemas', 'schema', path=self.path, mode='readonly')
+        store.set('b', {'*': 'y'})
+
+        self.assertEqual(store.get('a'), {'*': 'x'})
+        self.assertEqual(store.get('b'), {'*': 'y'})
+        self.assertEqual(sorted(store.keys()), ['a', 'b'])
+        self.assertNotIn('b', open_store('schemas', 'schema', path=self.path))
+        self.assertEqual(os.path.getmtime(filename), mtime)
+
+        self.assertEqual(len(open_store('concepts', 'concept', path=self.path, mode='readonly')), 0)
+
+    def test_store_interface(self):
+        class Partial(Store):
+            def get(self, key, default=None):
+                return default
+
+        self.assertRaises(TypeError, Partial)
+
+        for store in [MemoryStore(), SqliteStore(os.path.join(self.path, 'cache.sqlite3'), 'schemas'),
+                      open_store('concepts', 'concept', path=self.path)]:
+            store.set('a', 1)
+            store.clear()
+            self.assertEqual((len(store), store.get('a')), (0, None))
+
+    def test_memory_store(self):
+        open_store('schemas', 'schema', path=self.path).set('a', {'*': 'x'})
+
+        store = open_store('schemas', 'schema', path=self.path, mode='memory')
+
+        self.assertIsInstance(store, MemoryStore)
+        self.assertEqual(store.get('a'), {'*': 'x'})
+        self.assertEqual(len(open_store('schemas', 'schema', path=os.path.join(self.path, 'none'), mode='memory')), 0)
+
+    def test_configure(self):
+        open_store('schemas', 'schema', path=self.path).set('a', {'*': 'x'})
+
+        self.assertEqual(configure(cache_dir=self.path, mode='memory'), {'cache_dir': self.path, 'mode': 'memory'})
+        self.assertEqual(utils.schemas.get('a'), {'*': 'x'})
+        self.assertIsInstance(utils.concepts, MemoryStore)
+        self.assertRaises(ValueError, configure, mode='append')
+
+        self.assertEqual(
+            get_settings({'METAFORM_CACHE_DIR': self.path, 'METAFORM_CACHE_MODE': 'readonly'}),
+            {'cache_dir': self.path, 'mode': 'readonly'})
+
+    def test_concurrent_writes(self):
+        with ProcessPoolExecutor(max_workers=4) as pool:
+            list(pool.map(write_keys, [self.path] * 8, range(8)))
+
+        self.assertEqual(len(open_store('schemas', 'schema', path=self.path)), 800)
+
+    def test_deduplicated_fetch(self):
+        url = 'https://github.com/wefindx/schema/wiki/Sale#test'
+        fetched = []
+
+        def t_get_schema(url):
+            fetched.append(url)
+            time.sleep(0.1)
+            return {'*': url}
+
+        configure(cache_dir=self.path, mode='readwrite')
+        utils.t_get_schema = t_get_schema
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(utils.get_schema, [url] * 8))
+
+        self.assertEqual(results, [{'*': url}] * 8)
+        self.assertEqual(len(fetched), 1)
+
+    def test_save_term(self):
+        class Table(list):
+            def insert(self, record):
+                if not record['name']:
+                    raise ValueError('duplicate of nothing')
+                if record in self:
+                    raise sqlite3.IntegrityError('UNIQUE constraint failed: _terms.name')
+                self.append(record)
+
+        storage = {'types': {'_terms': Table()}}
+        record = {'name': 'wd-q82799', 'url': 'https://www.wikidata.org/wiki/Q82799'}
+
+        with redirect_stdout(io.StringIO()) as out:
+            utils.save_term(storage, record)
+            utils.save_term(storage, dict(record))
+            self.assertEqual(out.getvalue(), '')
+
+            utils.save_term(storage, {'name': ''})
+            self.assertIn('Could not save term', out.getvalue())
+
+        self.assertEqual(storage['types']['_terms'], [record])
+
+    def test_lock(self):
+        for i in range(1000):
+            with lock(str(i), self.path):
+                pass
+
+        self.assertEqual(len(cache._key_locks), LOCK_BUCKETS)
+
+    def test_get_schema_from_store(self):
+        url = 'https://github.com/wefindx/schema/wiki/Sale#test'
+        utils.schemas = MemoryStore({slug(url): {'*': url}})
+
+        self.assertEqual(utils.get_schema(url), {'*': url})
+
+    def test_memo(self):
+        memo = Memo(maxsize=2, ttl=None)
+        memo.set('a', 1)
+        memo.set('b', None)
+        memo.get('a')
+        memo.set('c', 3)
+
+        self.assertEqual(memo.get('a'), 1)
+        self.assertEqual(memo.get('b', 'missing'), 'missing')
+        self.assertEqual(memo.info().evictions, 1)
+
+        memo = Memo(ttl=0)
+        memo.set('a', 1)
+        self.assertEqual(memo.get('a', 'expired'), 'expired')
+
+    def test_translate_memo(self):
+        utils.concept_memo.clear()
+
+        records = [{'name': i, 'age': i} for i in range(100)]
+
+        self.assertEqual(translate(records, lang='en'), records)
+        self.assertEqual(cache_stats()['concepts']['misses'], 2)
+        self.assertEqual(cache_stats()['concepts']['currsize'], 2)
+
+    def test_concept_fetch_error(self):
+        url = 'https://www.wikidata.org/wiki/Q82799'
+        errors = [ConnectionError('offline')]
+
+        class Concept:
+            def __init__(self, url):
+                if errors:
+                    raise errors.pop()
+                self.concept = {'aliases': {'en': ['name']}}
+
+        utils.concepts, utils.Concept = MemoryStore(), Concept
+        utils.concept_memo.clear()
+
+        with redirect_stdout(io.StringIO()):
+            self.assertIsNone(utils.get_concept('WD:Q82799'))
+        self.assertEqual(utils.get_concept('WD:Q82799'), {'aliases': {'en': ['name']}})
+        self.assertEqual(utils.concepts.get(slug(url)), {'aliases': {'en': ['name']}})
+
+        self.assertIsNone(utils.get_concept('name'))
+        self.assertEqual(utils.concept_memo.get('name', MISSING), None)
+
+    def test_prefetch(self):
+        url = 'https://github.com/wefindx/schema/wiki/Sale#test'
+        fetched = []
+
+        class Concept:
+            def __init__(self, url):
+                fetched.append(url)
+                self.concept = {'aliases': {'en': [url.rsplit('/', 1)[-1]]}}
+
+        def t_get_schema(url):
+            fetched.append(url)
+            return {'*': url, 'a': 'WD:Q82799#string|to.string', 'b': {'*': 'price'}}
+
+        utils.schemas, utils.concepts = MemoryStore(), MemoryStore()
+        utils.t_get_schema, utils.Concept = t_get_schema, Concept
+
+        result = prefetch([{'*': url, 'a': 'x'}, {'*': url, 'b': 'y'}], concurrency=4)
+
+        self.assertEqual(list(result['schemas']), [url])
+        self.assertEqual(
+            sorted(key for key, concept in result['concepts'].items() if concept),
+            ['WD:Q82799', 'WD:Q82799#string', url.rsplit('#', 1)[0], url])
+        self.assertEqual(len(fetched), 5)
+
+        self.assertEqual(prefetch(url), {'schemas': {}, 'concepts': {}})
+        self.assertEqual(len(fetched), 5)
+
+        del fetched[:]
+        schema = {'*': 'WD:Q5', 'a': {'*': 'WD:Q82799#string|to.string'}, 'b': [{'*': 'price', 'c': 'WD:Q42'}]}
+        result = prefetch(schema)
+
+        self.assertEqual(result['schemas'], {})
+        self.assertEqual(set(result['concepts']), {'WD:Q5', 'WD:Q42'})
+        self.assertEqual(sorted(fetched), ['https://www.wikidata.org/wiki/Q42', 'https://www.wikidata.org/wiki/Q5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
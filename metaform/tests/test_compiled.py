@@ -0,0 +1,321 @@
+import datetime
+import io
+import json
+import pickle
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from metaform import (CompiledSchema, Dict, List, Router, Row, compile, formatize, get_compiled, normalize,
+                      normalize_many)
+
+
+class TestCompiled(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            'hello': 1.0,
+            'world': 2,
+            'how': ['is', {'are': {'you': 'doing'}}]
+        }
+        self.schema = {
+            '*': 'greeting',
+            'hello': {'*': 'length|lambda x: x+5.'},
+            'world': {'*': 'atoms|lambda x: str(x)+"ABC"'},
+            'how': [
+                 {
+                     '*': 'method',
+                     'are': {
+                         '*': 'yup',
+                         'you': {'*': 'me|lambda x: "-".join(list(x))'}
+                     }
+                 }
+            ]}
+        with open('metaform/tests/data/topics.json', 'r') as f:
+            self.topics = json.load(f)
+
+    def test_compile(self):
+        compiled = compile(self.schema)
+
+        self.assertIsInstance(compiled, CompiledSchema)
+        self.assertIs(compile(compiled), compiled)
+        self.assertEqual(compiled.table[('how', 0, 'are', 'you')].term, 'me')
+
+    def test_same_as_normalize(self):
+        compiled = compile(self.schema)
+
+        self.assertEqual(compiled.normalize(self.data), normalize(self.data, self.schema))
+        self.assertEqual(normalize(self.data, compiled), normalize(self.data, self.schema))
+
+    def test_same_as_normalize_lists(self):
+        topics_schema = [{
+            'id': {'*': 'topic-id'},
+            'type': {'*': '|lambda x: {0: "NEED", 1: "GOAL", 2: "IDEA", 3: "PLAN", 4: "STEP", 5: "TASK"}.get(x)'},
+            'owner': {'username': {'*': ''}, 'id': {'*': 'user-id'}},
+            'blockchain': {'*': '|lambda x: x and True or False'},
+            'parents': 'parent',
+        }]
+
+        self.assertEqual(
+            compile(topics_schema).normalize(self.topics),
+            normalize(self.topics, topics_schema)
+        )
+
+    def test_namespace_and_slugify(self):
+        schema = {
+            'name': 'https://www.wikidata.org/wiki/Q82799|lambda _: _.title()',
+            'age': {'*': 'A_b'},
+            'bad': {'*': 'x|lambda _: _ + 1 | 2'},
+        }
+        data = {'name': 'max', 'age': 3, 'bad': 1, 'other': 2}
+
+        for options in [{'namespace': True}, {'slugify': True}]:
+            self.assertEqual(
+                compile(schema, **options).normalize(data),
+                normalize(data, schema, **options)
+            )
+
+    def test_format_same_as_stages(self):
+        schema = {
+            '*': 'record',
+            'date': {'*': 'created#isodate'},
+            'count': {'*': 'total#integer|lambda x: x + "0"'},
+            'total#integer': {'*': 'sum'},
+            'a': {'*': 'b#string'},
+            'c': {'*': 'b#integer'},
+            'tags': [{'*': 'tag#string', 'id': {'*': 'tag-id#integer'}}],
+            'owner': {'*': '|lambda x: dict(x, name="x")', 'id': {'*': 'owner-id#integer'}},
+            'record': {'*': 'kind#url'},
+        }
+        records = [
+            {'date': '2005-04-30', 'count': '1', 'total#integer': '5', 'a': 1, 'c': '2', 'record': 'y',
+             'tags': [{'id': '3'}, 'z'], 'owner': {'id': '4', 'deep': {'x#integer': '5'}}},
+            {'c': '2', 'a': 1, 'other#float': '1.5', 'tags': ({'id': '6'},)},
+            {},
+        ]
+
+        for record in records:
+            expect = formatize(normalize(record, schema), ignore=['b'], no_convert=['url'])
+            self.assertEqual(compile(schema).format(record, ignore=['b'], no_convert=['url']), expect)
+            self.assertEqual(Dict(record).format(schema, anchors=False), formatize(normalize(record, schema)))
+
+        self.assertEqual(
+            List(records).format(schema, anchors=False),
+            [formatize(normalize(record, schema)) for record in records])
+
+    def test_get_compiled(self):
+        schema = {'a': {'*': 'b#integer'}}
+        record = {'a': '1'}
+
+        self.assertIs(get_compiled(schema), get_compiled({'a': {'*': 'b#integer'}}))
+        self.assertEqual(Dict(record).format(schema, anchors=False), {'b': 1})
+
+        schema['a']['*'] = 'c#integer'
+        self.assertEqual(Dict(record).format(schema, anchors=False), {'c': 1})
+        self.assertIsNot(get_compiled({1: {'*': 'a'}}), get_compiled({'1': {'*': 'a'}}))
+
+    def test_view(self):
+        calls = []
+        schema = {
+            '*': 'record',
+            'a': {'*': 'b#integer|lambda x: calls.append(x) or x'},
+            'c': {'*': 'b#string'},
+            'd': {'*': 'e', 'f': {'*': 'g#isodate|lambda x: calls.append(x) or x'}},
+            'h': [{'*': 'i#integer'}],
+            'j': {'*': '|lambda x: dict(x, k=1)'},
+            'record': {'*': 'kind'},
+        }
+        record = Dict({'a': '1', 'c': 2, 'd': {'f': '2005-04-30'}, 'h': ['3'], 'j': {'x#integer': '4'}, 'record': 'y'})
+
+        with patch.dict('metaform.__dict__', calls=calls):
+            view = record.view(schema)
+
+            self.assertEqual(view['e']['g'], datetime.datetime(2005, 4, 30))
+            self.assertEqual(view['e']['g'], datetime.datetime(2005, 4, 30))
+            self.assertEqual(calls, ['2005-04-30'])
+
+            expect = record.format(schema, anchors=False)
+            self.assertEqual(view, expect)
+            self.assertEqual(list(view), list(expect))
+            # Only format() converts 'a', that the view knows 'c' overwrites.
+            self.assertEqual(len(calls), 3)
+
+        self.assertEqual(Dict({'a#integer': '1'}).view()['a'], 1)
+        self.assertRaises(KeyError, view.__getitem__, 'a')
+        with self.assertRaises(TypeError):
+            view['a'] = 1
+
+    def test_format_fields(self):
+        calls = []
+        schema = {
+            'id': {'*': 'topic-id#integer'},
+            'title': {'*': 'name|lambda x: calls.append(x) or x.upper()'},
+            'owner': {'*': 'user', 'id': {'*': 'user-id#integer'}, 'name': {'*': '|lambda x: calls.append(x)'}},
+            'tags': [{'id': {'*': 'tag-id#integer'}, 'name': {'*': '|lambda x: calls.append(x)'}}],
+            'meta': {'*': '|lambda x: dict(x, checked=True)'},
+        }
+        records = List([
+            {'id': '1', 'title': 'a', 'owner': {'id': '2', 'name': 'x'}, 'tags': [{'id': '3', 'name': 'y'}, 'z'],
+             'meta': {'a': 1, 'b': 2}},
+            {'id': '4', 'tags': []},
+        ])
+
+        with patch.dict('metaform.__dict__', calls=calls):
+            self.assertEqual(
+                records.format(schema, anchors=False, fields=['topic-id', ['user', 'id'], ['tags', 'tag-id']]),
+                [{'topic-id': 1, 'user': {'user-id': 2}, 'tags': [{'tag-id': 3}, 'z']}, {'topic-id': 4, 'tags': []}])
+            self.assertEqual(calls, [])
+
+            self.assertEqual(
+                Dict(records[0]).format(schema, fields=['id', ['owner'], ['meta', 'checked']]),
+                {'topic-id#integer': '1', 'user': {'user-id#integer': '2', 'name': None}, 'meta': {'checked': True}})
+            self.assertEqual(calls, ['x'])
+
+    def test_format_fields_swapped_keys(self):
+        # The source key of each field is the normalized key of the other.
+        schema = {'c': {'*': 'a|lambda x: x + 1'}, 'a': {'*': 'c|lambda x: x * 10'}, 'd': {'*': 'e'}}
+        record = Dict({'c': 1, 'a': 2, 'd': 3})
+
+        self.assertEqual(record.format(schema, anchors=False, fields=['c']), {'c': 20})
+        self.assertEqual(record.format(schema, anchors=False, fields=['a']), {'a': 2})
+        self.assertEqual(record.format(schema, anchors=False, fields=['a', 'c', 'd']), {'a': 2, 'c': 20, 'e': 3})
+
+    def test_format_compact(self):
+        schema = {'id': {'*': 'https://www.wikidata.org/wiki/Q82799#integer'}, 'tags': [{'*': 'tag'}]}
+        records = List([{'id': '1', 'tags': [{'a': 1}]}, {'id': '2', 'tags': [{'a': 2}]}, {'id': '3', 'x': None}])
+
+        for options in [{}, {'anchors': False}, {'fields': ['id']}]:
+            self.assertEqual(records.format(schema, compact=True, **options), records.format(schema, **options))
+
+        rows = records.format(schema, anchors=False, compact=True)
+        self.assertIsInstance(rows[0], Row)
+        self.assertIs(rows[0].layout, rows[1].layout)
+        self.assertIs(rows[0]['tag'][0].layout, rows[1]['tag'][0].layout)
+        self.assertEqual(rows[2].get('x', 0), None)
+        self.assertEqual(rows[2].to_dict(), {'https://www.wikidata.org/wiki/Q82799': 3, 'x': None})
+        self.assertEqual(pickle.loads(pickle.dumps(rows)), rows)
+
+        row, expect = rows[2], {'https://www.wikidata.org/wiki/Q82799': 3, 'x': None}
+        self.assertEqual(list(row.values()), [3, None])
+        items = row.items()
+        self.assertEqual(list(items), list(expect.items()))
+        self.assertEqual(list(items), list(expect.items()))
+        self.assertTrue(row == expect and expect == row)
+        self.assertEqual(dict(row), expect)
+
+        for options in [{}, {'anchors': False}]:
+            self.assertEqual(
+                records.format(schema, compact=True, chunksize=2, **options), records.format(schema, **options))
+
+        with self.assertRaises(TypeError):
+            rows[0]['x'] = 1
+
+    def test_router(self):
+        schemas = {
+            'A': {'*': 'A', 'x': {'*': 'a#integer|lambda x: x + "0"'}},
+            'B': {'*': 'B', 'x': {'*': 'b#integer'}, 'y': [{'*': 'c'}]},
+        }
+        records = List([
+            {'*': 'A', 'x': '1'}, {'*': 'B', 'x': '2', 'y': [1]}, {'*': 'A', 'x': '3'}, {'*': 'B', 'x': '4', 'y': []},
+        ])
+        expect = [normalize(record, schemas[record['*']]) for record in records]
+
+        with patch('metaform.router.get_schema', side_effect=lambda key, refresh: schemas.get(key)) as get_schema:
+            router = Router()
+            self.assertEqual(router.normalize(records), expect)
+            self.assertEqual(router.normalize(iter(records)), expect)
+            self.assertEqual(get_schema.call_count, 2)
+            self.assertEqual(router.stats['A']['records'], 4)
+            self.assertEqual(set(router.throughput()), {'A', 'B'})
+
+            self.assertEqual(normalize_many(records), expect)
+            self.assertEqual(records.normalize(), expect)
+            self.assertEqual(records.format(anchors=False), [formatize(record) for record in expect])
+
+            # Records without '*' by the schema of the first record.
+            records = List([{'*': 'A', 'x': '1'}, {'x': '2'}, {'x': '3', 'y': 1}])
+            self.assertEqual(records.normalize(), normalize_many(records, schemas['A']))
+
+    def test_format_without_schema(self):
+        records = List([{'a': 'x', 'b#integer': '1'}, {'c': [{'d#float': '1.5'}]}])
+        expect = [{'a': 'x', 'b': 1}, {'c': [{'d': 1.5}]}]
+
+        self.assertEqual(records.format({}), records)
+        self.assertEqual(records.format({}, anchors=False), expect)
+        self.assertEqual(records.format({}, lang='en'), expect)
+        self.assertEqual(records.format(anchors=False), expect)
+
+    def test_router_options(self):
+        schema = {'*': 'A', 'x': {'*': 'Some Term#integer'}}
+
+        with patch('metaform.router.get_schema', return_value=schema):
+            record = {'*': 'A', 'x': '1'}
+            self.assertEqual(Router(slugify=True).format([record]), [compile(schema, slugify=True).format(record)])
+            self.assertNotEqual(Router(slugify=True).format([record]), Router().format([record]))
+
+    def test_normalize_many(self):
+        topics_schema = {
+            'id': {'*': 'topic-id'},
+            'type': {'*': '|lambda x: {0: "NEED", 1: "GOAL", 2: "IDEA", 3: "PLAN", 4: "STEP", 5: "TASK"}.get(x)'},
+            'owner': {'username': {'*': ''}, 'id': {'*': 'user-id|lambda x: x * 10'}},
+            'parents': [{'*': '|lambda x: -x'}],
+            'title': {'*': 'id|lambda x: x.upper()'},
+        }
+
+        expect = [normalize(topic, topics_schema) for topic in self.topics]
+
+        self.assertEqual(normalize_many(self.topics, topics_schema), expect)
+        self.assertEqual(List(self.topics).format(topics_schema), expect)
+
+    def test_normalize_many_renamed_to_same_key(self):
+        schema = {'a': {'*': 'b|lambda x: x + 1'}, 'c': {'*': 'b|lambda x: x * 10'}}
+        records = [{'a': 1, 'c': 2}, {'c': 2, 'a': 1}, {'a': 1, 'b': 5}]
+
+        self.assertEqual(
+            compile(schema).normalize_many(records),
+            [normalize(record, schema) for record in records]
+        )
+
+    def test_normalize_many_renamed_to_same_key_many(self):
+        # Every record has a key renamed to another of its keys (and to the
+        # one of a dict in it), that must not take the time of all of them.
+        schema = {
+            'c': {'*': 'c|lambda x: x'},
+            'a': {'*': 'b|lambda x: x + 1'},
+            'd': {'e': {'*': 'f|lambda x: x * 2'}},
+        }
+        records = [{'c': i, 'a': i, 'b': 5, 'd': {'f': 1, 'e': i}} for i in range(20000)]
+        records += [{'b': 5, 'a': 1, 'd': {'e': 1, 'f': 'x'}}]
+
+        self.assertEqual(
+            compile(schema).normalize_many(records),
+            [normalize(record, schema) for record in records]
+        )
+
+    def test_normalize_many_parallel(self):
+        schema = {
+            'id': {'*': 'topic-id|lambda x: x * 10'},
+            'owner': {'username': {'*': 'user|lambda x: x.upper()'}},
+        }
+        records = List(self.topics * 10)
+        expect = normalize_many(records, schema)
+
+        self.assertEqual(normalize_many(records, schema, workers=2, chunksize=7), expect)
+        self.assertEqual(records.format(schema, workers=2, chunksize=7), expect)
+
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(normalize_many(records, compile(schema), executor=executor, chunksize=7), expect)
+            self.assertCountEqual(
+                normalize_many(records, schema, executor=executor, chunksize=7, ordered=False), expect)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = normalize_many(records, schema, storage={'types': lambda: None}, workers=2)
+
+        self.assertEqual(result, expect)
+        self.assertIn('normalizing in this process', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,37 @@
 import datetime
+import io
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
 import unittest
+from contextlib import redirect_stdout
 from copy import deepcopy
 
-from metaform import Dict, align, convert, converters, formatize, normalize, template
+import yaml
+from metaform import (
+    Aligner, Dict, List, RuleError, align, convert, converters, formatize, infer, infer_shape, instrument, iterload,
+    load, normalize, profiling, read_csv, rules, template,
+)
+from metaform.aligner import to_arrow_array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 
 class TestMain(unittest.TestCase):
@@ -30,6 +58,47 @@ class TestMain(unittest.TestCase):
 
         self.assertEqual(convert(self.key, self.value, schema), expect)
 
+    def test_rule_cache(self):
+        schema = {'*': "IN:mindey/thing|lambda _: _.replace(',','') "}
+
+        rules.cache.clear()
+        convert(self.key, self.value, schema)
+        convert(self.key, self.value, schema)
+
+        info = rules.cache.info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+        rules.cache.resize(0)
+        self.assertEqual(rules.cache.info().currsize, 0)
+        rules.cache.resize(1024)
+
+    def test_broken_rule(self):
+        schema = {'*': 'IN:mindey/thing|lambda _: _.replace(,)'}
+
+        rules.cache.clear()
+        self.assertEqual(convert(self.key, self.value, schema), ('IN:mindey/thing', self.value))
+        self.assertRaises(RuleError, rules.cache.get, 'lambda _: _.replace(,)')
+        self.assertEqual(rules.cache.info().errors, 1)
+
+    def test_lazy_rule_names(self):
+        schema = {'*': 'IN:mindey/thing|lambda _: yaml.safe_load(_)'}
+
+        self.assertEqual(convert(self.key, '[1, 2]', schema), ('IN:mindey/thing', [1, 2]))
+
+    def test_lazy_import(self):
+        home = tempfile.mkdtemp()
+        code = (
+            'import sys, metaform; '
+            'print([m for m in ("metawiki", "typology", "requests", "yaml", "boltons") if m in sys.modules])'
+        )
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', code], env=dict(os.environ, HOME=home), universal_newlines=True)
+            self.assertEqual(output.strip(), '[]')
+            self.assertFalse(os.path.exists(os.path.join(home, '.metaform')))
+        finally:
+            shutil.rmtree(home)
+
     def test_normalization(self):
         data = [
             {
@@ -202,6 +271,52 @@ class TestMain(unittest.TestCase):
 
         self.assertEqual(formatize(ndata), expect)
 
+    def test_formatization_ignore(self):
+        ndata = [{'a#integer': '1', 'b#integer': '2', 'c#isodate': '2005-04-30'}] * 2
+
+        self.assertEqual(
+            formatize(ndata, ignore=['a'], no_convert=['isodate']),
+            [{'a': '1', 'b': 2, 'c': '2005-04-30'}] * 2)
+
+    def test_instrument(self):
+        schema = {
+            '*': 'instrumented',
+            'a': {'*': 'x#integer|lambda x: x.strip() + "0"'},
+            'b': {'*': 'y#isodate'},
+        }
+        records = List([{'a': ' 1', 'b': '2005-04-30'}, {'a': 2, 'b': 'x'}])
+        events = []
+
+        with instrument() as stats, instrument(lambda *event: events.append(event)):
+            with redirect_stdout(io.StringIO()):
+                result = records.format(schema, anchors=False)
+
+        self.assertEqual(result, [{'x': 10, 'y': datetime.datetime(2005, 4, 30)}, {'x': 2, 'y': 'x'}])
+        self.assertEqual(stats['format.calls'], 1)
+        self.assertEqual(stats['format.nodes'], 7)
+        self.assertGreater(stats['format.seconds'], 0)
+        self.assertEqual(stats['rule.evals'], 1)
+        self.assertEqual(stats['rule.errors'], 1)
+        self.assertEqual(stats['converter.errors'], 1)
+        self.assertIn(('format.calls', 1, {'schema': 'instrumented'}), events)
+        self.assertIn(('converter.errors', 1, {'key': 'y', 'format': 'isodate'}), events)
+
+        # Not instrumented after the block.
+        self.assertEqual(profiling.callbacks, [])
+        formatize({'a#integer': '1'})
+        self.assertNotIn('formatize.calls', stats)
+
+    def test_batch_converters(self):
+        self.assertEqual(converters.integer.many(['1', '2']), [1, 2])
+        self.assertEqual(converters.integer.many(iter(['1', 'x', None])), [1, 'x', None])
+        self.assertEqual(converters.float.many(['1.5', 2]), [1.5, 2.0])
+        self.assertEqual(converters.string.many([1, 'a']), ['1', 'a'])
+        self.assertEqual(
+            converters.isodate.many(['2005-04-30T10:00:00+02:00', 'April 30, 2005', 'x']),
+            [datetime.datetime(2005, 4, 30, 10, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+             datetime.datetime(2005, 4, 30), 'x'])
+        self.assertRaises(ValueError, converters.isodate.many, ['x'], silent=False)
+
     def test_dict_addition_1(self):
         '''
         testing Dict.__add__
@@ -302,6 +417,55 @@ class TestCore(unittest.TestCase):
         }
         self.assertEqual(template(self.data), expect)
 
+    def test_iterload(self):
+        path = tempfile.mkdtemp()
+        schema = {'id': {'*': 'topic-id|lambda x: x * 10'}}
+
+        try:
+            with open(os.path.join(path, 'topics.ndjson'), 'w') as f:
+                f.write('\n'.join(json.dumps(topic) for topic in self.topics))
+            with open(os.path.join(path, 'topics.yaml'), 'w') as f:
+                yaml.dump(self.topics, f)
+
+            for source in ['metaform/tests/data/topics.json',
+                           os.path.join(path, 'topics.ndjson'),
+                           os.path.join(path, 'topics.yaml')]:
+                records = iterload(source, schema=schema)
+
+                self.assertIsInstance(records, types.GeneratorType)
+                self.assertEqual(list(records), load(self.topics).format(schema))
+        finally:
+            shutil.rmtree(path)
+
+    @unittest.skipIf(pandas is None, 'requires pandas')
+    def test_read_csv(self):
+        path = tempfile.mkdtemp()
+        schema = {
+            'id': {'*': 'topic-id|to.integer'},
+            'created': {'*': 'date|to.unixtime'},
+            'title': {'*': 'title|lambda x: x.upper()'},
+        }
+
+        try:
+            filename = os.path.join(path, 'topics.csv')
+            with open(filename, 'w') as f:
+                f.write('id,created,title\n')
+                for i in range(10):
+                    f.write('{},{},topic {}\n'.format(i, 1114819200 + i, i))
+
+            df = read_csv(filename, schema=schema)
+
+            self.assertEqual(list(df.columns), ['topic-id', 'date', 'title'])
+            self.assertEqual(df['date'][0], datetime.datetime(2005, 4, 30, 0, 0))
+            self.assertEqual(df['title'][9], 'TOPIC 9')
+
+            chunks = list(read_csv(filename, schema=schema, chunksize=4))
+
+            self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+            self.assertTrue(pandas.concat(chunks).equals(df))
+        finally:
+            shutil.rmtree(path)
+
     def test_rename_keys(self):
         schema = {
             '*': 'greeting',
@@ -429,6 +593,95 @@ class TestCore(unittest.TestCase):
             ))), expect
         )
 
+    def test_aligner(self):
+        topics = ({'id': i, 'owner': {'name': 'A'}} for i in range(3))
+        comments = [
+            {'text': 'x', 'owner': None, 'deep': {'id': 7, 'name': 'B'}},
+            {'id': 8, 'name': 'C'},
+            {'id': 9, 'name': 'D'},
+        ]
+
+        aligner = Aligner([topics, comments], sample=3)
+
+        self.assertEqual(aligner.matching, {'id': [['id'], ['id']], 'name': [['owner', 'name'], ['name']]})
+        self.assertEqual(list(aligner), [
+            {'id': 0, 'name': 'A'}, {'id': 1, 'name': 'A'}, {'id': 2, 'name': 'A'},
+            {'id': None, 'name': None}, {'id': 8, 'name': 'C'}, {'id': 9, 'name': 'D'},
+        ])
+
+        self.assertEqual(list(align([comments[:1], comments[1:]], key_list=['name'])), [
+            {'name': 'B'}, {'name': 'C'}, {'name': 'D'}])
+        self.assertEqual(list(align([comments], sample=3, key_list=['text', 'name'])), [
+            {'text': 'x', 'name': None}, {'text': None, 'name': 'C'}, {'text': None, 'name': 'D'}])
+
+    def test_align_columns(self):
+        sources = [
+            [{'id': 1, 'owner': {'name': 'A'}, 'score': 1}, {'id': 2, 'owner': {'name': 'B'}, 'score': 2}],
+            ({'deep': {'id': i, 'name': None}, 'score': 0.5} for i in range(3, 6)),
+        ]
+
+        columns = align(sources, output='columns')
+
+        self.assertEqual(list(columns), ['id', 'name', 'score'])
+        self.assertEqual((columns['id'].typecode, columns['score'].typecode), ('q', 'd'))
+        self.assertEqual(list(columns['id']), [1, 2, 3, 4, 5])
+        self.assertEqual(list(columns['score']), [1, 2, 0.5, 0.5, 0.5])
+        self.assertEqual(columns['name'], ['A', 'B', None, None, None])
+
+        self.assertEqual(Aligner([[{'n': 1}], [{'n': 2 ** 70}]]).columns(chunksize=1), {'n': [1, 2 ** 70]})
+        self.assertRaises(ValueError, align, sources, output='frame')
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_align_numpy_columns(self):
+        columns = align([[{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}]], sample=2, output='columns', backend='numpy')
+
+        self.assertEqual(columns['a'].dtype, numpy.int64)
+        self.assertEqual(columns['a'].tolist(), [1, 2])
+        self.assertEqual(columns['b'].tolist(), ['x', 'y'])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_align_arrow_columns(self):
+        records = [
+            {'a': 1, 'b': 'x', 'c': {'d': 1, 'e': 'f'}},
+            {'a': 2, 'b': 3, 'c': None},
+            {'a': 3, 'b': None, 'c': 'e'},
+            {'a': 4, 'b': 1.5, 'c': {'d': None}},
+            {'a': 5, 'b': 'y', 'c': 2.5},
+        ]
+
+        table = align([records], sample=5, output='columns', backend='arrow')
+
+        self.assertEqual(table.column('a').type, pyarrow.int64())
+        self.assertEqual(table.column('b').to_pylist(), ['x', '3', None, '1.5', 'y'])
+        self.assertEqual(table.column('c').to_pylist(), ['{"d": 1, "e": "f"}', None, 'e', '{"d": null}', '2.5'])
+        self.assertEqual(json.loads(table.column('c')[0].as_py()), records[0]['c'])
+
+        column = to_arrow_array([[{'f': 'g'}, True], 'h', {'i': datetime.date(2005, 4, 30)}, 1])
+        self.assertEqual(column.to_pylist(), ['[{"f": "g"}, true]', 'h', '{"i": "2005-04-30"}', '1'])
+
+    def test_infer(self):
+        records = [
+            {'id': '1', 'score': '1.5', 'at': '2005-04-30', 'tags': [{'a': 1}], 'name': 'x'},
+            {'id': 2, 'score': 3, 'at': None, 'tags': [{'b': '2'}], 'name': '2'},
+            {'id': '3', 'extra': {'deep': {'x': True}}},
+        ]
+
+        self.assertEqual(infer(iter(records)), {
+            'id': {'*': '|to.integer'},
+            'score': {'*': '|to.float'},
+            'at': {'*': '|to.isodate'},
+            'tags': [{'a': {'*': ''}, 'b': {'*': '|to.integer'}, '*': ''}],
+            'name': {'*': ''},
+            'extra': {'deep': {'x': {'*': ''}}},
+            '*': '',
+        })
+        self.assertEqual(normalize(records[0], infer(records))['score'], 1.5)
+        self.assertEqual(
+            infer_shape(records).stats()[('id',)], {'count': 3, 'types': {'str': 2, 'int': 1}, 'converter': 'integer'})
+
+        self.assertEqual(infer_shape(({'n': i} for i in range(1000)), sample=10, seed=0).count, 10)
+        self.assertEqual(infer(records, with_self=False, suggest=False)['id'], {'*': ''})
+
     def test_keys_renaming(self):
         self.assertEqual(
             normalize({'A': 1}, {'A': {'*': 'B'}}),
@@ -1,4 +1,8 @@
 import unittest
+from copy import deepcopy
+
+from metaform import Dict
+from metaform.utils import Operation, _add, _sub, diff
 
 
 class TestUtils(unittest.TestCase):
@@ -12,6 +16,109 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual(result, expect)
 
+    def test_add_inplace(self):
+        a = {'x': {'y': {'z': 1}, 'u': 2}, 'm': 1, 'l': [{'1': 'A'}]}
+        b = {'x': {'y': {'z': 2}, 'u': 8}, 'm': [2], 'l': [{'2': 'B'}]}
+
+        expect = _add(a, b)
+
+        self.assertEqual(a['m'], 1)
+        self.assertIs(_add(a, b, inplace=True), a)
+        self.assertEqual(a, expect)
+
+    def test_add(self):
+        # Results of the former remap/getx/setx implementation.
+        cases = [
+            ({'x': 1, 'y': [1]}, {'x': 1, 'y': [2], 'z': 3}, {'x': 2, 'y': [1, 2], 'z': 3}),
+            ({'x': {'y': {'z': 1}, 'u': 2}, 'm': 1, 'l': [{'1': 'A'}]},
+             {'x': {'y': {'z': 2}, 'u': 8}, 'm': [2], 'l': [{'2': 'B'}]},
+             {'x': [{'y': [{'z': 3}, {'z': 2}], 'u': 10}, {'y': {'z': 2}, 'u': 8}], 'm': [1, [2]],
+              'l': [{'1': 'A', '2': 'B'}, {'2': 'B'}]}),
+            ({'s': 'a', 'n': None}, {'s': 'b', 'n': 2}, {'s': 'ab', 'n': 2}),
+            ({'x': 1}, {'x': 'a'}, {'x': [1, 'a']}),
+            ({'d': {'a': 1}}, {'d': {'a': 1.5, 'b': {'c': [1]}}},
+             {'d': [{'a': [1, 1.5], 'b': {'c': [1]}}, {'a': 1.5, 'b': {'c': [1]}}]}),
+            ({}, {'a': {'b': [1, 2]}}, {'a': {'b': [1, 2]}}),
+            ({'t': (1, 2)}, {'t': (3,)}, {'t': (1, 2, 3)}),
+            ({'t': [1]}, {'t': (2,)}, {'t': [[1], (2,)]}),
+            ({'t': 1}, {'t': (2, 3)}, {'t': [1, (2, 3)]}),
+            ({}, {'t': (1, 2)}, {'t': (1, 2)}),
+            # Raised, walking into the tuples.
+            ({}, {'t': (1, {'x': 1})}, {'t': (1, {'x': 1})}),
+            ({'t': 1}, {'t': (2, {'x': 1})}, {'t': [1, (2, {'x': 1})]}),
+            ({'t': ({'x': 1},)}, {'t': ({'x': 2},)}, {'t': ({'x': 1}, {'x': 2})}),
+        ]
+
+        for a, b, expect in cases:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(_add(a, b), expect)
+                self.assertEqual(_add(deepcopy(a), b, inplace=True), expect)
+
+    def test_dict_iadd(self):
+        total = Dict({'x': 1})
+        same = total
+
+        for part in [Dict({'x': 1}), Dict({'y': [1]}), Dict({'y': [2]})]:
+            total += part
+
+        self.assertIs(total, same)
+        self.assertEqual(total, {'x': 2, 'y': [1, 2]})
+
+    def test_sub(self):
+        cases = [
+            ({'a': 3, 'b': [2, {'x': 'y'}], 'c': 3, 'd': 4}, {'a': 2, 'b': {'x': 'y'}, 'c': 3, 'd': 4},
+             {'a': 1, 'b': [2]}),
+            ({'name': 'x', 'n': 2, 's': 'same'}, {'name': 'x', 'n': 1, 's': 'same'},
+             {'name': 'x', 'n': 1, 's': 'same'}),
+            ({'x': [1, {'y': 2}, 1, 3], 'n': 5, 't': 'a'}, {'x': [{'y': 2}, 1], 'n': 2, 't': 'b'},
+             {'x': [1, 3], 'n': 3, 't': 'a'}),
+            ({'a': {'b': 'x', 'c': 5}}, {'a': {'b': 'x', 'c': 2}}, {'a': {'b': 'x', 'c': 3}}),
+            ({'a': {'b': 1}, 'c': 2.5, 'd': None, 'e': [1, 2], 'f': 's'},
+             {'a': {'b': 1}, 'c': 1, 'd': 1, 'e': 2, 'f': 1},
+             {'a': {}, 'c': [], 'd': None, 'e': 2, 'f': []}),
+        ]
+
+        for a, b, expect in cases:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(_sub(a, b), expect)
+
+        a = {'x': [1, 2], '___previous_was_list___': 1}
+        self.assertEqual(_sub(a, {'x': [1], 'y': 1}), {'x': [2], '___previous_was_list___': 1})
+        self.assertEqual(a, {'x': [1, 2], '___previous_was_list___': 1})
+        self.assertEqual(list(_sub(a, {'x': 1})), ['x', '___previous_was_list___'])
+
+    def test_sub_long_lists(self):
+        a = {'x': [{'id': i} for i in range(20000)]}
+        b = {'x': [{'id': i} for i in range(0, 20000, 2)]}
+
+        self.assertEqual(_sub(a, b), {'x': [{'id': i} for i in range(1, 20000, 2)]})
+
+    def test_patch(self):
+        old = {'a': 1, 'b': [1, {'c': 2}], 'd': {'e': 'f'}, 'l': [1]}
+        new = {'a': 1, 'b': [1, {'c': 3}], 'd': {}, 'l': [1, 2], 'g': True}
+
+        patch = diff(old, new)
+
+        self.assertEqual(patch.apply(old), new)
+        self.assertEqual(patch.invert().apply(new), old)
+        self.assertEqual(old['d'], {'e': 'f'})
+        self.assertEqual(_sub(new, old, patch=True), patch)
+        self.assertEqual(diff(old, old), [])
+        self.assertEqual(diff(1, True).apply(1), True)
+
+    def test_patch_lists(self):
+        old = {'l': list(range(1000))}
+
+        for new in [{'l': old['l'] + [1000]}, {'l': [-1] + old['l']}, {'l': old['l'][:500] + ['x'] + old['l'][500:]},
+                    {'l': old['l'][1:]}, {'l': old['l'][:-2]}, {'l': []}]:
+            patch = diff(old, new)
+            self.assertEqual(patch.apply(old), new)
+            self.assertEqual(patch.invert().apply(new), old)
+
+        self.assertEqual(diff(old, {'l': old['l'] + [1000]}), [Operation('add', ('l', 1000), None, 1000)])
+        self.assertEqual(diff(old, {'l': old['l'][:10] + old['l'][11:]}), [Operation('remove', ('l', 10), 10, None)])
+        self.assertEqual(diff([1], [True]), [Operation('replace', (0,), 1, True)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,94 @@
+import importlib
 import operator
-import os
-import pathlib
-from collections import defaultdict
+import threading
+from collections import defaultdict, namedtuple
+from collections.abc import Mapping, Sequence, Set
 from copy import deepcopy
 from functools import reduce
 
-import metawiki
-import yaml
-from boltons.iterutils import remap
-from tinydb import Query, TinyDB
-from typology import Concept
-from typology.utils import get_schema as t_get_schema  # noqa
-from typology.utils import slug
+from metaform.cache import MISSING, MODES, Memo, conf_path, lock, open_store, settings  # noqa
+from metaform.profiling import callbacks, emit, fetch
 
-conf_path = os.path.join(str(pathlib.Path.home()), '.metaform')
 
-if not os.path.exists(conf_path):
-    os.makedirs(conf_path)
+def _attribute(module, name):
+    return lambda: getattr(importlib.import_module(module), name)
 
-concepts = TinyDB(os.path.join(conf_path, 'concepts.json'))
-schemas = TinyDB(os.path.join(conf_path, 'schemas.json'))
+
+# {module attribute: loader}, loaded on first use, rather than on import
+# (so that importing metaform neither opens the cache, nor imports typology).
+# The attributes can still be replaced, e.g.:
+# >>> metaform.utils.concepts = MemoryStore()
+# Loading the stores takes the lock of the cache file (see open_store), so
+# they are loaded before taking the lock of a key (see fetching), not in it.
+LAZY = {
+    'concepts': lambda: open_store('concepts', 'concept'),
+    'schemas': lambda: open_store('schemas', 'schema'),
+    'Concept': _attribute('typology', 'Concept'),
+    't_get_schema': _attribute('typology.utils', 'get_schema'),
+}
+
+_lazy_lock = threading.Lock()
+
+
+def lazy(name):
+    '''
+    Returns the module attribute name, loading it on first use.
+    '''
+    value = globals().get(name, MISSING)
+
+    if value is MISSING:
+        with _lazy_lock:
+            value = globals().get(name, MISSING)
+            if value is MISSING:
+                value = globals()[name] = LAZY[name]()
+
+    return value
+
+
+def __getattr__(name):
+    if name in LAZY:
+        return lazy(name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def configure(cache_dir=None, mode=None):
+    '''
+    Sets the cache directory and mode of the schema and concept stores
+    (None keeps the current one), which are reopened on next use. Returns
+    the settings.
+
+    E.g., build a snapshot of the cache into an image:
+    >>> configure(cache_dir='/opt/metaform', mode='readwrite')
+    >>> prefetch(schema_urls)
+
+    and share it read-only between the workers (or, export
+    METAFORM_CACHE_DIR=/opt/metaform METAFORM_CACHE_MODE=readonly):
+    >>> configure(cache_dir='/opt/metaform', mode='readonly')
+    '''
+    if mode is not None and mode not in MODES:
+        raise ValueError('Unknown cache mode: {} (expected one of {})'.format(mode, ', '.join(MODES)))
+
+    with _lazy_lock:
+        if cache_dir is not None:
+            settings['cache_dir'] = cache_dir
+        if mode is not None:
+            settings['mode'] = mode
+
+        for name in ('concepts', 'schemas'):
+            globals().pop(name, None)
+
+    concept_memo.clear()
+
+    return dict(settings)
+
+
+def slug(url, skip_valid=True):
+    from typology.utils import slug
+    return slug(url, skip_valid=skip_valid)
+
+
+# {key: concept or None}, in front of get_concept()
+concept_memo = Memo(maxsize=10000, ttl=3600)
 
 
 def dictget(d, mapList):
@@ -70,6 +139,7 @@ def metaplate(data, with_self=True, print_yaml=False):
         'b': {'*': ''}
     }
     '''
+    from boltons.iterutils import remap
     if isinstance(data, list):
         # TODO: reserved key
         data = {'_#list#_': data}
@@ -105,12 +175,58 @@ def metaplate(data, with_self=True, print_yaml=False):
         remapped = remapped['_#list#_']
 
     if print_yaml:
+        import yaml
         print(yaml.dump(remapped))
     else:
         return remapped
 
 
+def fetching(key):
+    '''
+    Lock, that one thread (and, if the cache is shared, one process) at a
+    time fetches key under, so that the others wait for it, rather than
+    fetch it again.
+    '''
+    return lock(key, settings['cache_dir'] if settings['mode'] == 'readwrite' else None)
+
+
+def save_term(storage, record):
+    '''
+    Saves the {name, url} record of a slugified term into the terms table of
+    storage (storage['types']['_terms']), once per name. Upserts, where the
+    table supports it (e.g., pymongo), so that concurrent writers neither
+    fail, nor duplicate it.
+    '''
+    table = storage['types']['_terms']
+
+    if hasattr(table, 'update_one'):
+        table.update_one({'name': record['name']}, {'$setOnInsert': record}, upsert=True)
+        return
+
+    try:
+        table.insert(record)
+    except duplicate_errors():
+        pass
+    except Exception as e:
+        print('-> Could not save term: {} ({})'.format(record['name'], e))
+
+
+def duplicate_errors():
+    '''
+    Exceptions of inserting a record with a unique key, that exists.
+    '''
+    import sqlite3
+
+    try:
+        from pymongo.errors import DuplicateKeyError
+    except ImportError:
+        return (sqlite3.IntegrityError,)
+
+    return (sqlite3.IntegrityError, DuplicateKeyError)
+
+
 def get_schema(path, refresh=False):
+    import metawiki
 
     url = metawiki.name_to_url(str(path))
 
@@ -119,68 +235,226 @@ def get_schema(path, refresh=False):
          list(metawiki.NAMESPACES.keys()) + ['https://github.com', 'https://www.wikidata.org']]
     ):
 
-        Schemas = Query()
-
         slg = slug(url)
+        schemas = lazy('schemas')
 
-        result = schemas.search(Schemas.slug == slg)
+        result = schemas.get(slg, MISSING)
 
-        if not result or refresh:
+        if callbacks:
+            emit('schema.hits' if result is not MISSING else 'schema.misses', 1, {'schema': url})
 
-            if refresh:
+        if result is MISSING or refresh:
+            t_get_schema = lazy('t_get_schema')
 
-                try:
-                    schemas.remove(Schemas.slug == slg)
-                except BaseException:
-                    pass
+            with fetching(slg):
 
-            try:
-                schema = t_get_schema(url)
-                result = {'slug': slg, 'schema': schema}
-                schemas.insert(result)
+                if refresh:
+                    schemas.delete(slg)
+                else:
+                    # Fetched, while waiting for the lock.
+                    result = schemas.get(slg, MISSING)
+                    if result is not MISSING:
+                        return result
 
-                return schema
+                try:
+                    with fetch('schema', url):
+                        schema = t_get_schema(url)
+                    schemas.set(slg, schema)
 
-            except BaseException:
-                print("-> Could not find schema: {}".format(url))
+                    return schema
+
+                except BaseException:
+                    print("-> Could not find schema: {}".format(url))
 
         else:
-            return result[0]['schema']
+            return result
 
 
 def get_concept(value, refresh=False):
+    '''
+    Returns the concept for a key (e.g., '_:date'), or None, if it is not
+    a concept. Results (also None) are memoized in concept_memo by key,
+    except for the concepts, that could not be fetched (so that they are
+    fetched again, rather than be None, until the memo expires).
+    '''
+    key = str(value)
+
+    if not refresh:
+        concept = concept_memo.get(key, MISSING)
+        if concept is not MISSING:
+            if callbacks:
+                emit('concept.hits', 1, {'concept': key})
+            return concept
+
+    concept = _get_concept(value, refresh=refresh)
+    if concept is MISSING:
+        return None
+
+    concept_memo.set(key, concept)
 
-    url = metawiki.name_to_url(str(value))
+    return concept
+
+
+def _get_concept(value, refresh=False):
+    '''
+    Returns the concept for a key, None, if it is not a concept, or MISSING,
+    if it could not be fetched.
+    '''
+    import metawiki
+
+    try:
+        url = metawiki.name_to_url(str(value))
+    except metawiki.MetaWikiError:
+        # Plain keys (e.g., 'name') are not concepts.
+        return
 
     if any(
         [str(url).startswith(it) for it in
          list(metawiki.NAMESPACES.keys()) + ['https://github.com', 'https://www.wikidata.org']]
     ):
 
-        Concepts = Query()
-
         slg = slug(url)
+        concepts = lazy('concepts')
 
-        result = concepts.search(Concepts.slug == slg)
+        result = concepts.get(slg, MISSING)
 
-        if not result or refresh:
+        if callbacks:
+            emit('concept.hits' if result is not MISSING else 'concept.misses', 1, {'concept': url})
 
-            try:
-                concept = Concept(url).concept
-                result = {'slug': slg, 'concept': concept}
-                concepts.insert(result)
+        if result is MISSING or refresh:
+            Concept = lazy('Concept')
 
-                return concept
+            with fetching(slg):
 
-            except BaseException:
-                print("-> Undefined concept: {}".format(url))
+                if not refresh:
+                    # Fetched, while waiting for the lock.
+                    result = concepts.get(slg, MISSING)
+                    if result is not MISSING:
+                        return result
+
+                try:
+                    with fetch('concept', url):
+                        concept = Concept(url).concept
+                    concepts.set(slg, concept)
 
-        elif result:
-            return result[0]['concept']
+                    return concept
+
+                except BaseException:
+                    print("-> Undefined concept: {}".format(url))
+                    return MISSING
+
+        else:
+            return result
     else:
         return
 
 
+def get_references(data):
+    '''
+    Returns the schemas ('*' of records), and the concepts (keys) that
+    records refer to, e.g.:
+    >>> get_references([{'*': 'GH:wefindx/schema/Sale#test', 'WD:Q82799': 'Max'}])
+    ({'GH:wefindx/schema/Sale#test'}, {'WD:Q82799'})
+    '''
+    from boltons.iterutils import remap
+    records = data if isinstance(data, list) else [data]
+
+    schema_refs = {
+        record['*'] for record in records
+        if isinstance(record, dict) and isinstance(record.get('*'), str) and record['*']
+    }
+
+    concept_refs = set()
+
+    def visit(path, key, value):
+        if isinstance(key, str) and key != '*':
+            concept_refs.add(key)
+        return key, value
+
+    remap(records, visit=visit)
+
+    return schema_refs, concept_refs
+
+
+def get_terms(schema):
+    '''
+    Returns the terms of a schema (keys that records normalize to), also
+    without the '#format' suffix (keys that records formatize to), e.g.:
+    >>> get_terms({'a': 'price#EUR|to.decimal', 'b': {'*': 'WD:Q82799'}})
+    {'price#EUR', 'price', 'WD:Q82799'}
+    '''
+    from boltons.iterutils import remap
+    terms = set()
+
+    def add(spec):
+        term = spec.split('|', 1)[0]
+        if term:
+            terms.add(term)
+            terms.add(term.rsplit('#', 1)[0])
+
+    def visit(path, key, value):
+        if isinstance(value, str):
+            add(value)
+        return key, value
+
+    remap(schema, visit=visit)
+
+    return terms
+
+
+def is_cached(store, value):
+    '''
+    Checks, if the schema or concept that value names is in the store
+    (names that are not schemas or concepts count as cached).
+    '''
+    import metawiki
+    try:
+        return slug(metawiki.name_to_url(str(value))) in store
+    except metawiki.MetaWikiError:
+        return True
+
+
+def prefetch(source, concurrency=8, refresh=False):
+    '''
+    Resolves the schemas and concepts, that source refers to, fetching the
+    ones missing from the cache in parallel. Source is a schema URL (or a
+    list of them), a schema (a dict with '*' at its root), or records.
+
+    So that normalize(), formatize() and translate() run from the cache:
+    >>> prefetch(records, concurrency=16)
+    >>> metaform.load(records).format('en')
+
+    Returns {'schemas': {ref: schema}, 'concepts': {key: concept}} fetched.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    if isinstance(source, str):
+        source = [source]
+
+    if isinstance(source, list) and all(isinstance(item, str) for item in source):
+        schema_refs, concept_refs = set(source), set()
+    elif isinstance(source, dict) and '*' in source:
+        schema_refs, concept_refs = set(), get_terms(source)
+    else:
+        schema_refs, concept_refs = get_references(source)
+
+    fetched = {'schemas': {}, 'concepts': {}}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+
+        missing = [ref for ref in schema_refs if refresh or not is_cached(lazy('schemas'), ref)]
+        fetched['schemas'] = dict(zip(missing, pool.map(lambda ref: get_schema(ref, refresh=refresh), missing)))
+
+        for ref in schema_refs:
+            schema = fetched['schemas'][ref] if ref in fetched['schemas'] else get_schema(ref)
+            if schema:
+                concept_refs |= get_terms(schema)
+
+        missing = [key for key in concept_refs if refresh or not is_cached(lazy('concepts'), key)]
+        fetched['concepts'] = dict(zip(missing, pool.map(lambda key: get_concept(key, refresh=refresh), missing)))
+
+    return fetched
+
+
 def get_concept_paths(data, k=[], exclude=[dict, list]):
     '''
     Given, something like:
@@ -191,7 +465,6 @@ def get_concept_paths(data, k=[], exclude=[dict, list]):
 
     So that we can retrieve them with dictget()
     '''
-
     if isinstance(k, list):
         paths = {key: [] for key in k}
     else:
@@ -200,18 +473,28 @@ def get_concept_paths(data, k=[], exclude=[dict, list]):
     if not k:
         paths = defaultdict(list)
 
-    def visit(path, key, value):
-        if isinstance(k, list):
-            if key in k or not k:
-                if type(value) not in exclude:
-                    paths[key].append(list(path) + [key])
+    def walk(data, path):
+        # In the order of remap(), that is, the items of a container first.
+        if isinstance(data, Mapping):
+            items = data.items()
+        elif isinstance(data, (Sequence, Set)) and not isinstance(data, (str, bytes)):
+            items = enumerate(data)
         else:
-            if key == k or not k:
-                if type(value) not in exclude:
-                    paths.append(list(path) + [key])
-        return key, value
+            return
 
-    remap(data, visit=visit)
+        for key, value in items:
+            walk(value, path + [key])
+
+            if isinstance(k, list):
+                if key in k or not k:
+                    if type(value) not in exclude:
+                        paths[key].append(path + [key])
+            else:
+                if key == k or not k:
+                    if type(value) not in exclude:
+                        paths.append(path + [key])
+
+    walk(data, [])
 
     return paths
 
@@ -319,21 +602,81 @@ def setx(data, path, value, other):
     return data
 
 
-def _add(a, b):
-    a = deepcopy(a)
+UNRESOLVED = object()
 
-    def visit(path, key, value):
-        fpath = path + (key,)
-        val = getx(a, fpath)
+ATOMS = {str, int, float, bool, type(None), tuple}
 
-        if val is not None:
+
+def _lookup(node, key):
+    try:
+        return node[key]
+    except BaseException:
+        return UNRESOLVED
+
+
+def _add(a, b, inplace=False):
+    '''
+    Adds b to a (or, to a copy of a, unless inplace), e.g.:
+    >>> _add({'x': 1, 'y': [1]}, {'x': 1, 'y': [2], 'z': 3})
+    {'x': 2, 'y': [1, 2], 'z': 3}
+
+    Walking b bottom-up, each value is added to the value at the same path
+    in a: values of the same type by +, or if they have none, kept when
+    equal, paired as [a, b] otherwise (and also when types differ). Items
+    of lists in both a and b are left to the addition of the lists.
+    Tuples are values, rather than walked item by item (so, the ones of a
+    and b are concatenated), as their items can not be set.
+
+    It is a single pass over b, that keeps the nodes of a along the current
+    path, rather than looking them up (getx, setx) from the root each time.
+    '''
+    from boltons.iterutils import default_exit
+    if not inplace:
+        a = deepcopy(a)
+    elif a is b:
+        b = deepcopy(b)
+
+    path = []
+    anodes = [a]
+    bnodes = [b]
+
+    def resolve(depth):
+        # The node of a at path[:depth], creating the missing ones like setx.
+        d = depth
+        while anodes[d] is UNRESOLVED:
+            d -= 1
+
+        r = anodes[d]
+        for j in range(d, depth):
+            p = path[j]
+
+            if (isinstance(r, dict) and (p not in r.keys())) or \
+               (isinstance(r, list) and (p not in range(len(r)))):
+                other_type = type(bnodes[j + 1])
+
+                if isinstance(r, dict):
+                    r[p] = other_type()
+                else:
+                    r += [other_type()]
+
+            r = r[p]
+            anodes[j + 1] = r
+
+        return r
+
+    def visit(depth, key, value):
+        parent = anodes[depth - 1]
+
+        val = UNRESOLVED if parent is UNRESOLVED else _lookup(parent, key)
+
+        if val is not UNRESOLVED and val is not None:
             if not isinstance(val, type(value)):
                 new_val = [val, value]
             else:
                 # If upper element is concatable, don't add item values per se.
-                if type(getx(a, fpath[:-1])) in [list, tuple]:
-                    if type(getx(b, fpath[:-1])) in [list, tuple]:
-                        return key, value
+                if parent is not UNRESOLVED and type(parent) in [list, tuple]:
+                    if type(bnodes[depth - 1]) in [list, tuple]:
+                        return
 
                 if hasattr(val, '__add__'):
                     new_val = val + value
@@ -342,14 +685,55 @@ def _add(a, b):
                         new_val = val
                     else:
                         new_val = [val, value]
+        else:
+            new_val = value
+
+        r = resolve(depth - 1)
 
-            setx(a, fpath, new_val, b)
+        try:
+            r[key] = new_val
+        except BaseException:
+            # do nothing #
+            pass
+
+    def walk(node):
+        # Returns a copy of node, visiting its items after their own items.
+        if isinstance(node, (str, bytes, tuple)):
+            return node
+        elif isinstance(node, Mapping):
+            items = node.items()
+        elif isinstance(node, (Sequence, Set)):
+            items = enumerate(node)
         else:
-            setx(a, fpath, value, b)
+            return node
 
-        return key, value
+        depth = len(path) + 1
+        new_items = []
+
+        for key, item in items:
+            path.append(key)
+            bnodes.append(item)
 
-    remap(b, visit=visit)
+            if type(item) in ATOMS:
+                anodes.append(UNRESOLVED)
+            else:
+                parent = anodes[depth - 1]
+                anodes.append(UNRESOLVED if parent is UNRESOLVED else _lookup(parent, key))
+                item = walk(item)
+
+            visit(depth, key, item)
+            new_items.append((key, item))
+
+            path.pop()
+            bnodes.pop()
+            anodes.pop()
+
+        if type(node) is dict:
+            return dict(new_items)
+
+        return default_exit(None, None, node, node.__class__(), new_items)
+
+    walk(b)
     return a
 
 
@@ -371,57 +755,209 @@ def delx(data, path):
     return data
 
 
-def _sub(a, b):
+Operation = namedtuple('Operation', ['op', 'path', 'old', 'new'])
+
+REMOVED = object()
+
+
+def _freeze(value):
     '''
+    Hashable key of a value, equal for equal values of the same types (so,
+    list items are matched by a dict lookup, rather than pairwise).
+    '''
+    if isinstance(value, Mapping):
+        return ('dict', frozenset((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(_freeze(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return ('set', frozenset(_freeze(item) for item in value))
+    try:
+        return (type(value), hash(value), value)
+    except TypeError:
+        return ('repr', repr(value))
+
+
+def _remove(items, others):
+    '''
+    Returns items without others, removing an item once for every equal
+    one of others.
+    '''
+    counts = defaultdict(int)
+    for other in others:
+        counts[_freeze(other)] += 1
+
+    result = []
+    for item in items:
+        key = _freeze(item)
+        if counts[key]:
+            counts[key] -= 1
+        else:
+            result.append(deepcopy(item))
+
+    return items.__class__(result)
+
+
+def _subtract(a, b):
+    '''
+    What is left of a (a copy), after subtracting b from it, or REMOVED.
+    '''
+    if a is None:
+        return None
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        result = a.__class__()
+        for key, value in a.items():
+            if key in b:
+                value = _subtract(value, b[key])
+                if value is REMOVED:
+                    continue
+            else:
+                value = deepcopy(value)
+            result[key] = value
+        return result
+
+    if isinstance(a, list) and isinstance(b, (list, dict)):
+        return _remove(a, b if isinstance(b, list) else [b])
+
+    if isinstance(a, type(b)):
+        if hasattr(a, '__sub__'):
+            value = a - b
+            return value if value else REMOVED
+        return deepcopy(a)
+
+    # Of other types, what of a is also in b.
+    items = a if isinstance(a, list) else [a]
+    others = b if isinstance(b, list) else [b]
+    value = [deepcopy(item) for item in items if item in others]
+    return value[0] if len(value) == 1 else value
+
+
+def _sub(a, b, patch=False):
+    '''
+    Subtracts b from a (from a copy of a), e.g.:
     >>> _sub({'a': 3, 'b': [2, {'x': 'y'}], 'c': 3, 'd': 4},
-             {'a': 2, 'b': {'x': 'y'}, 'c': 3, 'd': 4})
+    ...      {'a': 2, 'b': {'x': 'y'}, 'c': 3, 'd': 4})
+    {'a': 1, 'b': [2]}
 
-    {'a': 1, 'b': 2}
+    Walking a and b together, each value of a is subtracted the value at
+    the same path in b: values of the same type by - (and dropped, if
+    nothing is left, e.g., equal numbers), or if they have none, kept (e.g.,
+    strings), values of other types are the ones of a, that are also in b
+    (so, mostly, []), and lists lose the items of b (or, b), once for every
+    equal item of it. Dicts are subtracted key by key, and kept, if emptied.
+
+    With patch=True, returns the Patch, that turns b into a, instead.
     '''
-    a = deepcopy(a)
-    a['___previous_was_list___'] = False
+    if patch:
+        return diff(b, a)
 
-    def visit(path, key, value):
-        fpath = path + (key,)
-        vala = getx(a, fpath)
-        valb = value
+    result = _subtract(a, b)
 
-        if isinstance(getx(a, fpath[:-1]), list):
-            valA = getx(a, fpath, inany=True)
-        else:
-            valA = None
-
-        if vala is not None:
-            if not isinstance(vala, type(valb)):
-                if not isinstance(vala, list):
-                    vala = [vala]
-                if not isinstance(valb, list):
-                    valb = [valb]
-                new_val = [v for v in vala if v in valb]
-                if len(new_val) == 1:
-                    new_val = new_val[0]
-                if not a['___previous_was_list___']:
-                    setx(a, fpath, new_val, b)
-                a['___previous_was_list___'] = False
-                # print('>>', a, (vala, valb))
-            elif hasattr(vala, '__sub__'):
-                new_val = vala - valb
-                if not a['___previous_was_list___']:
-                    if new_val:
-                        setx(a, fpath, new_val, b)
-                    else:
-                        delx(a, fpath)
+    if result is REMOVED:
+        return a.__class__() if isinstance(a, (dict, list)) else None
 
-        else:
-            if valA is not None:
-                # print(valA)
-                npath, _ = valA
-                # print('->', a)
-                delx(a, npath[:-1])
-                # print('-<', a)
-                a['___previous_was_list___'] = True
-        return key, value
+    return result
 
-    remap(b, visit=visit)
-    del a['___previous_was_list___']
-    return a
+
+class Patch(list):
+    '''
+    List of operations, that turn one value into another, where each
+    operation is Operation(op, path, old, new), with op one of 'add',
+    'remove', 'replace'.
+
+    >>> patch = diff({'a': 1, 'b': [1, 2]}, {'a': 1, 'b': [1, 3], 'c': 4})
+    >>> patch
+    [Operation(op='replace', path=('b', 1), old=2, new=3), Operation(op='add', path=('c',), old=None, new=4)]
+    >>> patch.apply({'a': 1, 'b': [1, 2]})
+    {'a': 1, 'b': [1, 3], 'c': 4}
+    >>> patch.invert().apply({'a': 1, 'b': [1, 3], 'c': 4})
+    {'a': 1, 'b': [1, 2]}
+    '''
+
+    def apply(self, data, inplace=False):
+        if not inplace:
+            data = deepcopy(data)
+
+        for operation in self:
+            if not operation.path:
+                data = deepcopy(operation.new)
+                continue
+
+            parent = dictget(data, operation.path[:-1])
+            if operation.op == 'remove':
+                del parent[operation.path[-1]]
+            elif operation.op == 'add' and isinstance(parent, list):
+                parent.insert(operation.path[-1], deepcopy(operation.new))
+            else:
+                parent[operation.path[-1]] = deepcopy(operation.new)
+
+        return data
+
+    def invert(self):
+        ops = {'add': 'remove', 'remove': 'add', 'replace': 'replace'}
+        return Patch(
+            Operation(ops[operation.op], operation.path, operation.new, operation.old)
+            for operation in reversed(self))
+
+
+def _diff(old, new, path, patch):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in old.items():
+            if key in new:
+                _diff(value, new[key], path + (key,), patch)
+            else:
+                patch.append(Operation('remove', path + (key,), deepcopy(value), None))
+        for key, value in new.items():
+            if key not in old:
+                patch.append(Operation('add', path + (key,), None, deepcopy(value)))
+
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_lists(old, new, path, patch)
+
+    elif type(old) is not type(new) or old != new:
+        patch.append(Operation('replace', path, deepcopy(old), deepcopy(new)))
+
+
+def _diff_lists(old, new, path, patch):
+    # Items equal at the start, and at the end of both (by their keys) are
+    # left as they are, the ones in between are diffed pairwise, and the
+    # rest of the longer list is removed, or added.
+    old_keys = [_freeze(item) for item in old]
+    new_keys = [_freeze(item) for item in new]
+
+    start = 0
+    common = min(len(old), len(new))
+    while start < common and old_keys[start] == new_keys[start]:
+        start += 1
+
+    end = 0
+    while end < common - start and old_keys[-1 - end] == new_keys[-1 - end]:
+        end += 1
+
+    old_items = old[start:len(old) - end]
+    new_items = new[start:len(new) - end]
+
+    for index, (x, y) in enumerate(zip(old_items, new_items), start):
+        _diff(x, y, path + (index,), patch)
+
+    index = start + len(new_items)
+    for item in old_items[len(new_items):]:
+        patch.append(Operation('remove', path + (index,), deepcopy(item), None))
+
+    for index, item in enumerate(new_items[len(old_items):], start + len(old_items)):
+        patch.append(Operation('add', path + (index,), None, deepcopy(item)))
+
+
+def diff(old, new):
+    '''
+    Returns the Patch, that turns old into new. Items of lists are matched
+    by their keys (see _freeze), so that adding, or removing items at the
+    start, or the end of a list (or, in one place of it) takes as many
+    operations as the items added, or removed.
+
+    >>> diff({'a': 1, 'b': 2}, {'a': 1})
+    [Operation(op='remove', path=('b',), old=2, new=None)]
+    '''
+    patch = Patch()
+    _diff(old, new, (), patch)
+    return patch
@@ -21,7 +21,6 @@ setup(
         "metawiki",
         "typology",
         "metadir",
-        "tinydb",
         "python-dateutil",
     ],
     extras_require={